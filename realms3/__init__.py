@@ -174,7 +174,7 @@ def error_handler(e):
 
 login_manager = LoginManager()
 db = SQLAlchemy()
-cache = Cache(config={"CACHE_DEFAULT_TIMEOUT": 5.0})
+cache = Cache()
 assets = Assets()
 from realms3.modules.search.models import Search
 search = Search()
@@ -0,0 +1,134 @@
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No cross process locking, one writing process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on a file, shared with other processes.
+
+    :param path: Lock file, created if missing.
+
+    """
+    with open(path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class FileLock(object):
+    """Lock held by one thread of one process at a time.
+
+    :param path: Lock file, created if missing.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self._lock:
+            with file_lock(self.path):
+                yield
+
+
+class LocalConnection(object):
+    """SQLite connection of the calling thread, opened on first use.
+
+    Connections are in autocommit mode, see :func:`transaction`.
+
+    :param path: Path of the database.
+    :param setup: Called with every new connection, e.g. to create tables.
+
+    """
+
+    def __init__(self, path, setup=None):
+        self.path = path
+        self.setup = setup
+        self._local = threading.local()
+
+    def get(self):
+        """:return: sqlite3.Connection"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            if self.setup is not None:
+                self.setup(db)
+            self._local.db = db
+        return db
+
+
+@contextmanager
+def transaction(db):
+    """Run a block in a write transaction, rolled back if it raises.
+
+    :param db: sqlite3.Connection in autocommit mode.
+
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+
+class Periodic(object):
+    """Calls a function every ``interval`` seconds in a daemon thread.
+
+    Exceptions are logged and the next call happens as planned.
+
+    :param func: Called without arguments.
+    :param name: Name of the thread, also used in log messages.
+
+    """
+
+    def __init__(self, func, name):
+        self.func = func
+        self.name = name
+        self._thread = None
+        self._stop = None
+
+    def start(self, interval):
+        """Start calling, unless already started.
+
+        :param interval: Seconds between calls.
+
+        """
+        if self._thread is not None:
+            return
+
+        stop = self._stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    self.func()
+                except Exception:
+                    logger.exception("%s failed", self.name)
+
+        self._thread = threading.Thread(target=loop, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread started by :meth:`start`."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread = self._stop = None
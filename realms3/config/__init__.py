@@ -72,14 +72,34 @@ class Config(object):
 
     CACHE_MEMCACHED_SERVERS = ["127.0.0.1:11211"]
 
-    # Valid options: simple, elasticsearch, whoosh
+    # Cached page data is keyed on commit ids, so it never goes stale
+    CACHE_DEFAULT_TIMEOUT = 6 * 60 * 60
+
+    # Valid options: simple, elasticsearch, whoosh, sqlite
     SEARCH_TYPE = "simple"
 
     ELASTICSEARCH_URL = "http://127.0.0.1:9200"
     ELASTICSEARCH_FIELDS = ["name"]
+    ELASTICSEARCH_BULK_CHUNK_SIZE = 500
 
     WHOOSH_INDEX = "/tmp/whoosh"
     WHOOSH_LANGUAGE = "en"
+    # Writer used to index many pages at once, e.g. by `search rebuild_index`
+    WHOOSH_WRITER_PROCS = 1
+    WHOOSH_WRITER_LIMITMB = 256
+
+    # SQLite database for the sqlite search type, needs SQLite built with FTS5
+    SQLITE_SEARCH_INDEX = "/tmp/realms3-search.sqlite"
+
+    # Index updates are queued here on save and applied in the background, in
+    # batches of SEARCH_QUEUE_BATCH_SIZE every SEARCH_QUEUE_INTERVAL seconds.
+    # Set to None to update the search index during the request.
+    SEARCH_QUEUE = "/tmp/realms3-search-queue.sqlite"
+    SEARCH_QUEUE_BATCH_SIZE = 500
+    SEARCH_QUEUE_INTERVAL = 1
+
+    # Simple search matches words of page names, set to also match words of content
+    SIMPLE_SEARCH_CONTENT = False
 
     # Get ReCaptcha Keys for your domain here:
     # https://www.google.com/recaptcha/admin#whyrecaptcha
@@ -94,6 +114,28 @@ class Config(object):
     # Path on file system where wiki data will reside
     WIKI_PATH = "/tmp/wiki"
 
+    # Max bytes of page content kept in memory, per process
+    WIKI_BLOB_CACHE_SIZE = 64 * 1024 * 1024
+    WIKI_TREE_CACHE_SIZE = 32 * 1024 * 1024
+
+    # Limits on pages pulled in through imports, to bound cycles and fan-out
+    WIKI_PARTIALS_MAX_DEPTH = 5
+    WIKI_PARTIALS_MAX_PAGES = 50
+
+    # Seconds a commit waits for concurrent saves to batch with, 0 to not wait
+    WIKI_COMMIT_WINDOW = 0
+
+    # Write pages to a working tree as well as to git, False also allows WIKI_PATH to be a bare repository
+    WIKI_CHECKOUT = True
+
+    # Pack loose git objects once there are more than WIKI_MAX_LOOSE_OBJECTS, and
+    # repack everything once there are more than WIKI_MAX_PACKS packs. Checked every
+    # WIKI_MAINTENANCE_INTERVAL seconds in the background, 0 to only run `realms3 wiki maintain`
+    # Loose objects and packs made redundant are removed by the following run
+    WIKI_MAX_LOOSE_OBJECTS = 1000
+    WIKI_MAX_PACKS = 20
+    WIKI_MAINTENANCE_INTERVAL = 0
+
     # Name of page that will act as home
     WIKI_HOME = "home"
 
@@ -1,8 +1,17 @@
+import multiprocessing
+from contextlib import contextmanager
+
 import click
+from dulwich.diff_tree import (
+    CHANGE_DELETE,
+    CHANGE_RENAME,
+    RenameDetector,
+    tree_changes,
+)
 from flask import current_app
 
 from realms3 import search, cli_group
-from realms3.modules.wiki.models import Wiki
+from realms3.lib.util import filename_to_cname
 
 
 @cli_group(short_help="Search Module")
@@ -10,28 +19,192 @@ def cli():
     pass
 
 
+_repo = None
+
+
+def _init_worker(path):
+    global _repo
+    from dulwich.repo import Repo
+
+    _repo = Repo(path)
+
+
+def _load_bodies(pages):
+    """Read and decode the content of a chunk of pages, in a worker process."""
+    bodies = []
+    for name, sha, body in pages:
+        body["content"] = _repo.object_store[sha].data.decode("utf-8", "replace")
+        bodies.append((name, body))
+    return bodies
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _body(name, info, times):
+    ctime, mtime = times
+    return dict(
+        name=name,
+        message=info["last"]["message"],
+        username=info["last"]["author"],
+        updated_on=mtime,
+        created_on=ctime,
+    )
+
+
+def _index_pages(wiki, pages, count, processes, chunk_size):
+    """Index (name, blob sha, body) tuples, loading content in worker processes."""
+    chunks = _chunks(pages, chunk_size)
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(
+            processes, initializer=_init_worker, initargs=(wiki.path,)
+        )
+        loaded = pool.imap(_load_bodies, chunks)
+    else:
+        _init_worker(wiki.path)
+        loaded = map(_load_bodies, chunks)
+
+    try:
+        with click.progressbar(length=count, label="Indexing pages") as bar:
+            for bodies in loaded:
+                search.index_wiki_bulk(bodies)
+                bar.update(len(bodies))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+processes_option = click.option(
+    "--processes", default=1, help="Processes reading page content from the repo."
+)
+chunk_size_option = click.option(
+    "--chunk-size", default=500, help="Pages indexed at once."
+)
+
+
+@contextmanager
+def _writing():
+    """Keep the search queue from writing to the index meanwhile."""
+    queue = current_app.extensions.get("search_queue")
+    if queue is None:
+        yield
+        return
+    with queue.lock.locked():
+        yield
+
+
+def _rebuild(wiki, processes, chunk_size):
+    # Wiki
+    search.delete_index("wiki")
+    wiki.history_index.update(wiki.repo)
+    head = wiki.history_index.head
+    index = wiki.index
+    revs = wiki.history_index.path_revs()
+
+    def pages():
+        for entry in index:
+            info = revs.get(entry["filename"])
+            if info is None:
+                # Staged but never committed
+                continue
+            body = _body(entry["name"], info, (entry["ctime"], entry["mtime"]))
+            yield entry["name"], entry["sha"], body
+
+    _index_pages(wiki, pages(), len(index), processes, chunk_size)
+    if head is not None:
+        search.set_indexed_commit(head)
+
+
 @cli.command()
-def rebuild_index():
-    """ Rebuild search index
-    """
+@processes_option
+@chunk_size_option
+def rebuild_index(processes, chunk_size):
+    """Rebuild search index"""
     if current_app.config.get("SEARCH_TYPE") == "simple":
         click.echo("Search type is simple, try using elasticsearch.")
         return
 
-    # Wiki
-    search.delete_index("wiki")
-    wiki = Wiki(current_app.config["WIKI_PATH"])
-    for entry in wiki.get_index():
-        page = wiki.get_page(entry["name"])
-        if not page:
-            continue
-        info = next(page.history)
-        body = dict(
-            name=page.name,
-            content=page.data,
-            message=info["message"],
-            username=info["author"],
-            updated_on=entry["mtime"],
-            created_on=entry["ctime"],
-        )
-        search.index_wiki(page.name, body)
+    with _writing():
+        _rebuild(current_app.extensions["wiki"], processes, chunk_size)
+
+
+@cli.command()
+@processes_option
+@chunk_size_option
+def sync_index(processes, chunk_size):
+    """Update search index with commits made since it was last indexed"""
+    if current_app.config.get("SEARCH_TYPE") == "simple":
+        click.echo("Search type is simple, it is always in sync.")
+        return
+
+    with _writing():
+        _sync(current_app.extensions["wiki"], processes, chunk_size)
+
+
+@cli.command()
+def drain_queue():
+    """Apply search index updates queued on save"""
+    queue = current_app.extensions.get("search_queue")
+    if queue is None:
+        click.echo("Search queue is disabled.")
+        return
+
+    click.echo("Applied {0} queued updates.".format(queue.drain()))
+
+
+def _sync(wiki, processes, chunk_size):
+    wiki.history_index.update(wiki.repo)
+    head = wiki.history_index.head
+    if head is None:
+        click.echo("Wiki has no commits.")
+        return
+
+    indexed = search.indexed_commit()
+    if indexed == head:
+        click.echo("Search index is up to date.")
+        return
+    try:
+        old_tree = wiki.repo[indexed.encode("ascii")].tree if indexed else None
+    except KeyError:
+        old_tree = None
+    if old_tree is None:
+        click.echo("Commit of the search index unknown, rebuilding it.")
+        _rebuild(wiki, processes, chunk_size)
+        return
+
+    object_store = wiki.repo.object_store
+    changed = []
+    deleted = 0
+    for change in tree_changes(
+        object_store,
+        old_tree,
+        wiki.repo[head.encode("ascii")].tree,
+        rename_detector=RenameDetector(object_store),
+    ):
+        if change.type in (CHANGE_DELETE, CHANGE_RENAME):
+            search.delete_wiki(filename_to_cname(change.old.path.decode("utf-8")))
+            deleted += 1
+        if change.new.path:
+            changed.append((change.new.path.decode("utf-8"), change.new.sha))
+
+    revs = wiki.history_index.path_revs()
+    times = wiki.history_index.path_times()
+
+    def pages():
+        for filename, sha in changed:
+            name = filename_to_cname(filename)
+            yield name, sha, _body(name, revs[filename], times[filename])
+
+    _index_pages(wiki, pages(), len(changed), processes, chunk_size)
+    search.set_indexed_commit(head)
+    click.echo("Indexed {0} pages, deleted {1}.".format(len(changed), deleted))
@@ -1,5 +1,19 @@
+from flask import current_app
+
 from realms3 import search
-from realms3.modules.wiki.models import WikiPage
+from realms3.modules.wiki.models import WikiPage, WikiTransaction
+
+
+def before_first_request():
+    queue = current_app.extensions.get("search_queue")
+    if queue is not None:
+        queue.start()
+
+
+def _indexer():
+    # The queue if there is one, so saves don't wait for the search backend
+    queue = current_app.extensions.get("search_queue")
+    return search if queue is None else queue
 
 
 @WikiPage.after("write")
@@ -9,10 +23,16 @@ def wiki_write_page(page, content, message=None, username=None, email=None, **kw
         # using simple search or none
         return
 
+    if kwargs.get("rv") is None:
+        # Nothing was committed
+        return
+
+    # What was committed, which differs from content when edits were merged
+    content = page.data.decode("utf-8", "replace")
     body = dict(
         name=page.name, content=content, message=message, email=email, username=username
     )
-    return search.index_wiki(page.name, body)
+    return _indexer().index_wiki(page.name, body)
 
 
 @WikiPage.before("rename")
@@ -21,7 +41,7 @@ def wiki_rename_page_del(page, *args, **kwargs):
     if not hasattr(search, "index_wiki"):
         return
 
-    return search.delete_wiki(page.name)
+    return _indexer().delete_wiki(page.name)
 
 
 @WikiPage.after("rename")
@@ -35,4 +55,36 @@ def wiki_delete_page(page, *args, **kwargs):
     if not hasattr(search, "index_wiki"):
         return
 
-    return search.delete_wiki(page.name)
+    if kwargs.get("rv") is None:
+        return
+
+    return _indexer().delete_wiki(page.name)
+
+
+@WikiTransaction.after("save_transaction")
+def wiki_save_transaction(
+    transaction, message=None, username=None, email=None, **kwargs
+):
+
+    if not hasattr(search, "index_wiki"):
+        return
+
+    if kwargs.get("rv") is None:
+        return
+
+    indexer = _indexer()
+    for name in transaction.deleted:
+        indexer.delete_wiki(name)
+    indexer.index_wiki_bulk(
+        (
+            name,
+            dict(
+                name=name,
+                content=content,
+                message=message,
+                email=email,
+                username=username,
+            ),
+        )
+        for name, content in transaction.written
+    )
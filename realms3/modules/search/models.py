@@ -1,24 +1,45 @@
+import os
 import re
+import sqlite3
 import sys
+import threading
 
+from dulwich.objects import Blob
 from flask import g, current_app
+from six import text_type
 
+from realms3.concurrency import LocalConnection, transaction
 from realms3.lib.util import filename_to_cname
 
+from .queue import IndexQueue
+
+# Elasticsearch index holding what the other indexes are up to date with
+STATE_INDEX = "realms3-state"
+
 
 def simple(app):
-    return SimpleSearch()
+    return SimpleSearch(content=app.config["SIMPLE_SEARCH_CONTENT"])
 
 
 def whoosh(app):
-    return WhooshSearch(app.config["WHOOSH_INDEX"], app.config["WHOOSH_LANGUAGE"])
+    return WhooshSearch(
+        app.config["WHOOSH_INDEX"],
+        app.config["WHOOSH_LANGUAGE"],
+        procs=app.config["WHOOSH_WRITER_PROCS"],
+        limitmb=app.config["WHOOSH_WRITER_LIMITMB"],
+    )
+
+
+def sqlite(app):
+    return SqliteSearch(app.config["SQLITE_SEARCH_INDEX"])
 
 
 def elasticsearch(app):
     from flask_elastic import Elastic
 
     fields = app.config.get("ELASTICSEARCH_FIELDS")
-    return ElasticSearch(Elastic(app), fields)
+    chunk_size = app.config.get("ELASTICSEARCH_BULK_CHUNK_SIZE", 500)
+    return ElasticSearch(Elastic(app), fields, chunk_size=chunk_size)
 
 
 class Search(object):
@@ -29,42 +50,180 @@ class Search(object):
     def init_app(self, app):
         search_obj = globals()[app.config["SEARCH_TYPE"]]
         app.extensions["search"] = search_obj(app)
+        # Simple search is in-process, it is cheap enough to update on save
+        if app.config["SEARCH_QUEUE"] and app.config["SEARCH_TYPE"] != "simple":
+            app.extensions["search_queue"] = IndexQueue(
+                app.config["SEARCH_QUEUE"],
+                app.extensions["search"],
+                batch_size=app.config["SEARCH_QUEUE_BATCH_SIZE"],
+                interval=app.config["SEARCH_QUEUE_INTERVAL"],
+            )
 
     def __getattr__(self, item):
         return getattr(current_app.extensions["search"], item)
 
 
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return value
+
+
 class BaseSearch:
-    pass
+    def index_wiki_bulk(self, docs):
+        """Index many pages at once.
+
+        :param docs: Iterable of (name, body) tuples, as for ``index_wiki``.
+        :return: int -- Number of pages indexed
+
+        """
+        count = 0
+        for name, body in docs:
+            self.index_wiki(name, body)
+            count += 1
+        return count
+
+    def indexed_commit(self):
+        """Commit id the wiki index reflects, as recorded by ``set_indexed_commit``.
+
+        :return: str -- None if unknown, e.g. after ``delete_index``
+
+        """
+        return None
+
+    def set_indexed_commit(self, commit_id):
+        """Record the commit id the wiki index reflects.
+
+        :param commit_id: Commit id (hex).
+
+        """
 
 
 class SimpleSearch(BaseSearch):
+    """Search on words of page names, and optionally of content.
+
+    Uses an in-process inverted index. It follows the wiki's index snapshot,
+    pages whose blob changed are indexed again on the next query, and hooks
+    update it right away for writes made by this process.
+
+    Results hold the start of each page, kept when it is indexed, so queries
+    don't read pages. Without content indexing they only hold names.
+
+    :param content: Index words of page content too.
+    :param max_results: Most results returned, pages matching more words first.
+    :param excerpt_size: Characters of content kept for results.
+
+    """
+
+    def __init__(self, content=False, max_results=100, excerpt_size=200):
+        self.content = content
+        self.max_results = max_results
+        self.excerpt_size = excerpt_size
+        self._key = None
+        self._docs = {}
+        self._postings = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _name_tokens(name):
+        return set(name.lower().replace("/", "-").split("-"))
+
+    @staticmethod
+    def _content_tokens(content):
+        return set(re.findall(r"\w+", content.lower()))
+
+    def _add(self, name, sha, content=None):
+        self._remove(name)
+        tokens = self._name_tokens(name)
+        excerpt = ""
+        if self.content and content is not None:
+            if not isinstance(content, text_type):
+                content = content.decode("utf-8", "replace")
+            tokens |= self._content_tokens(content)
+            excerpt = content[: self.excerpt_size]
+        for token in tokens:
+            self._postings.setdefault(token, set()).add(name)
+        self._docs[name] = sha, tokens, excerpt
+
+    def _remove(self, name):
+        doc = self._docs.pop(name, None)
+        if doc is None:
+            return
+        for token in doc[1]:
+            names = self._postings[token]
+            names.discard(name)
+            if not names:
+                del self._postings[token]
+
+    def _refresh(self, wiki):
+        snapshot = wiki.index
+        if snapshot.key is not None and snapshot.key == self._key:
+            return
+        with self._lock:
+            names = set()
+            for entry in snapshot:
+                name = re.sub(r"//+", "/", filename_to_cname(entry["name"]))
+                names.add(name)
+                doc = self._docs.get(name)
+                if doc is None or doc[0] != entry["sha"]:
+                    content = wiki.get_blob(entry["sha"]) if self.content else None
+                    self._add(name, entry["sha"], content)
+            for name in set(self._docs) - names:
+                self._remove(name)
+            self._key = snapshot.key
+
+    def index_wiki(self, name, body):
+        self.index_wiki_bulk([(name, body)])
+
+    def index_wiki_bulk(self, docs):
+        count = 0
+        with self._lock:
+            for name, body in docs:
+                content = body["content"]
+                if isinstance(content, text_type):
+                    content = content.encode("utf-8")
+                self._add(name, Blob.from_string(content).id, content)
+                count += 1
+        return count
+
+    def delete_wiki(self, name):
+        with self._lock:
+            self._remove(name)
+
+    def delete_index(self, index):
+        with self._lock:
+            self._docs.clear()
+            self._postings.clear()
+            self._key = None
+
     def wiki(self, query):
-        res = []
-        for entry in g.current_wiki.get_index():
-            name = filename_to_cname(entry["name"])
-            name = re.sub(r"//+", "/", name)
-            if set(query.split()).intersection(name.replace("/", "-").split("-")):
-                page = g.current_wiki.get_page(name)
-
-                # this can be None, not sure how
-                if page:
-                    res.append(dict(name=name, content=page.data))
-        return res
+        if not query:
+            return []
+
+        self._refresh(g.current_wiki)
+        hits = {}
+        with self._lock:
+            for token in set(query.lower().split()):
+                for name in self._postings.get(token, ()):
+                    hits[name] = hits.get(name, 0) + 1
+            names = sorted(hits, key=lambda name: (-hits[name], name))
+            return [
+                dict(name=name, content=self._docs[name][2])
+                for name in names[: self.max_results]
+            ]
 
     def users(self, query):
         pass
 
 
 class WhooshSearch(BaseSearch):
-    def __init__(self, index_path, language):
+    def __init__(self, index_path, language, procs=1, limitmb=128):
         from whoosh import index as whoosh_index
         from whoosh.fields import Schema, TEXT, ID
         from whoosh import qparser
         from whoosh.highlight import UppercaseFormatter
         from whoosh.analysis import SimpleAnalyzer, LanguageAnalyzer
         from whoosh.lang import has_stemmer, has_stopwords
-        import os
 
         if not has_stemmer(language) or not has_stopwords(language):
             # TODO Display a warning?
@@ -78,6 +237,9 @@ class WhooshSearch(BaseSearch):
         self.formatter = UppercaseFormatter()
 
         self.index_path = index_path
+        self.procs = procs
+        self.limitmb = limitmb
+        self.commit_path = os.path.join(index_path, "realms3-commit")
 
         if not os.path.exists(index_path):
             try:
@@ -100,14 +262,14 @@ class WhooshSearch(BaseSearch):
 
     def index(self, index, doc_type, id_=None, body=None):
         writer = self.search_index.writer()
-        writer.update_document(
-            path=id_.decode("utf-8"), body=body["content"].decode("utf-8")
-        )
+        writer.update_document(path=_text(id_), body=_text(body["content"]))
         writer.commit()
 
     def delete(self, id_):
         with self.search_index.searcher() as s:
-            doc_num = s.document_number(path=id_.decode("utf-8"))
+            doc_num = s.document_number(path=_text(id_))
+            if doc_num is None:
+                return
             writer = self.search_index.writer()
             writer.delete_document(doc_num)
             writer.commit()
@@ -115,6 +277,20 @@ class WhooshSearch(BaseSearch):
     def index_wiki(self, name, body):
         self.index("wiki", "page", id_=name, body=body)
 
+    def index_wiki_bulk(self, docs):
+        # One writer and one commit, procs > 1 builds segments in subprocesses
+        writer = self.search_index.writer(procs=self.procs, limitmb=self.limitmb)
+        count = 0
+        try:
+            for name, body in docs:
+                writer.update_document(path=_text(name), body=_text(body["content"]))
+                count += 1
+        except BaseException:
+            writer.cancel()
+            raise
+        writer.commit()
+        return count
+
     def delete_wiki(self, name):
         self.delete(id_=name)
 
@@ -123,6 +299,21 @@ class WhooshSearch(BaseSearch):
 
         self.search_index.close()
         self.search_index = whoosh_index.create_in(self.index_path, schema=self.schema)
+        if os.path.exists(self.commit_path):
+            os.remove(self.commit_path)
+
+    def indexed_commit(self):
+        try:
+            with open(self.commit_path) as f:
+                return f.read().strip() or None
+        except IOError:
+            return None
+
+    def set_indexed_commit(self, commit_id):
+        tmp_path = self.commit_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(commit_id)
+        os.replace(tmp_path, self.commit_path)
 
     def wiki(self, query):
         if not query:
@@ -149,26 +340,156 @@ class WhooshSearch(BaseSearch):
         pass
 
 
+class SqliteSearch(BaseSearch):
+    """Full text search in a local SQLite FTS5 index, ranked with BM25.
+
+    Looking up a column of an FTS5 table scans all of it, so the rowid of each
+    page is kept in a regular table and pages are replaced and removed by rowid.
+
+    :param index_path: Path of the SQLite database.
+    :param name_weight: Weight of matches in page names over matches in content.
+
+    """
+
+    def __init__(self, index_path, name_weight=10.0):
+        self.index_path = index_path
+        self.name_weight = name_weight
+        self._connection = LocalConnection(index_path, setup=self._setup)
+        try:
+            self.db
+        except sqlite3.Error as e:
+            sys.exit("Error opening SQLite search index: {0}".format(e))
+
+    @staticmethod
+    def _setup(db):
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS wiki"
+            " USING fts5(name, content, tokenize='unicode61')"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS pages"
+            " (name TEXT PRIMARY KEY, wiki_rowid INTEGER NOT NULL)"
+        )
+
+    @property
+    def db(self):
+        return self._connection.get()
+
+    @staticmethod
+    def _remove(db, name):
+        row = db.execute(
+            "SELECT wiki_rowid FROM pages WHERE name = ?", (name,)
+        ).fetchone()
+        if row is not None:
+            db.execute("DELETE FROM wiki WHERE rowid = ?", row)
+            db.execute("DELETE FROM pages WHERE name = ?", (name,))
+
+    def index_wiki(self, name, body):
+        self.index_wiki_bulk([(name, body)])
+
+    def index_wiki_bulk(self, docs):
+        count = 0
+        with transaction(self.db) as db:
+            for name, body in docs:
+                self._remove(db, name)
+                rowid = db.execute(
+                    "INSERT INTO wiki (name, content) VALUES (?, ?)",
+                    (name, _text(body["content"])),
+                ).lastrowid
+                db.execute(
+                    "INSERT INTO pages (name, wiki_rowid) VALUES (?, ?)", (name, rowid)
+                )
+                count += 1
+        return count
+
+    def delete_wiki(self, name):
+        with transaction(self.db) as db:
+            self._remove(db, name)
+
+    def delete_index(self, index):
+        with transaction(self.db) as db:
+            db.execute("DELETE FROM wiki")
+            db.execute("DELETE FROM pages")
+            db.execute("DELETE FROM state WHERE key = 'commit'")
+
+    def indexed_commit(self):
+        row = self.db.execute("SELECT value FROM state WHERE key = 'commit'").fetchone()
+        return row[0] if row else None
+
+    def set_indexed_commit(self, commit_id):
+        self.db.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES ('commit', ?)",
+            (commit_id,),
+        )
+
+    def wiki(self, query):
+        if not query:
+            return []
+
+        # Quote words so user input can't be taken for FTS5 query syntax
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        match = " ".join('"{0}"'.format(word) for word in words)
+
+        rows = self.db.execute(
+            "SELECT name, snippet(wiki, 1, '**', '**', '...', 32) FROM wiki"
+            " WHERE wiki MATCH ? ORDER BY bm25(wiki, ?, 1.0) LIMIT 100",
+            (match, self.name_weight),
+        )
+        return [dict(name=name, content=content) for name, content in rows]
+
+    def users(self, query):
+        pass
+
+
 class ElasticSearch(BaseSearch):
-    def __init__(self, elastic, fields):
+    def __init__(self, elastic, fields, chunk_size=500):
         self.elastic = elastic
         self.fields = fields
+        self.chunk_size = chunk_size
 
     def index(self, index, doc_type, id_=None, body=None):
         return self.elastic.index(index=index, doc_type=doc_type, id=id_, body=body)
 
     def delete(self, index, doc_type, id_):
-        return self.elastic.delete(index=index, doc_type=doc_type, id=id_)
+        return self.elastic.delete(index=index, doc_type=doc_type, id=id_, ignore=[404])
 
     def index_wiki(self, name, body):
         self.index("wiki", "page", id_=name, body=body)
 
+    def index_wiki_bulk(self, docs):
+        from elasticsearch import helpers
+
+        actions = (
+            dict(_index="wiki", _type="page", _id=name, _source=body)
+            for name, body in docs
+        )
+        count, _ = helpers.bulk(self.elastic, actions, chunk_size=self.chunk_size)
+        return count
+
     def delete_wiki(self, name):
         self.delete("wiki", "page", id_=name)
 
     def delete_index(self, index):
+        self.delete(STATE_INDEX, "state", index)
         return self.elastic.indices.delete(index=index, ignore=[400, 404])
 
+    def indexed_commit(self):
+        res = self.elastic.get(
+            index=STATE_INDEX, doc_type="state", id="wiki", ignore=[404]
+        )
+        if not res.get("found"):
+            return None
+        return res["_source"]["commit"]
+
+    def set_indexed_commit(self, commit_id):
+        self.index(STATE_INDEX, "state", id_="wiki", body=dict(commit=commit_id))
+
     def wiki(self, query):
         if not query:
             return []
@@ -0,0 +1,130 @@
+import json
+
+from realms3.concurrency import FileLock, LocalConnection, Periodic, transaction
+
+
+class IndexQueue(object):
+    """Durable queue of search index updates, drained in the background.
+
+    Updates are stored in SQLite, one row per page, so a page saved many times
+    before the queue is drained is indexed once, with its last content. A daemon
+    thread indexes queued pages in batches every ``interval`` seconds, under a
+    lock file so that one process at a time writes to the search index.
+
+    :param path: Path of the SQLite database.
+    :param search: Search backend updates are applied to.
+    :param batch_size: Most pages indexed at once.
+    :param interval: Seconds between drains.
+
+    """
+
+    def __init__(self, path, search, batch_size=500, interval=1):
+        self.path = path
+        self.search = search
+        self.batch_size = batch_size
+        self.interval = interval
+        # Held while writing to the search index
+        self.lock = FileLock(path + ".lock")
+        self._connection = LocalConnection(path, setup=self._setup)
+        self._periodic = Periodic(self.drain, "search-queue")
+
+    @staticmethod
+    def _setup(db):
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS queue"
+            " (name TEXT PRIMARY KEY, seq INTEGER NOT NULL, body TEXT)"
+        )
+
+    @property
+    def db(self):
+        return self._connection.get()
+
+    def _put(self, rows):
+        with transaction(self.db) as db:
+            for name, body in rows:
+                db.execute(
+                    "INSERT OR REPLACE INTO queue (name, seq, body)"
+                    " VALUES (?, (SELECT IFNULL(MAX(seq), 0) + 1 FROM queue), ?)",
+                    (name, body),
+                )
+
+    @staticmethod
+    def _dumps(body):
+        body = dict(body)
+        if isinstance(body.get("content"), bytes):
+            body["content"] = body["content"].decode("utf-8", "replace")
+        return json.dumps(body)
+
+    def index_wiki(self, name, body):
+        """Queue a page to be indexed, replacing updates queued for it.
+
+        :param name: Page name.
+        :param body: dict -- As for the backend's ``index_wiki``.
+
+        """
+        self._put([(name, self._dumps(body))])
+
+    def index_wiki_bulk(self, docs):
+        """Queue pages to be indexed, in one transaction.
+
+        :param docs: Iterable of (name, body) tuples.
+        :return: int -- Number of pages queued
+
+        """
+        rows = [(name, self._dumps(body)) for name, body in docs]
+        self._put(rows)
+        return len(rows)
+
+    def delete_wiki(self, name):
+        """Queue a page to be removed from the index, replacing updates queued for it.
+
+        :param name: Page name.
+
+        """
+        self._put([(name, None)])
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def drain(self):
+        """Apply every queued update to the search index.
+
+        Rows are removed once applied, unless they were queued again meanwhile.
+        If the backend fails, what is left stays queued for the next drain.
+
+        :return: int -- Number of updates applied
+
+        """
+        db = self.db
+        count = 0
+        with self.lock.locked():
+            while True:
+                rows = db.execute(
+                    "SELECT name, seq, body FROM queue ORDER BY seq LIMIT ?",
+                    (self.batch_size,),
+                ).fetchall()
+                if not rows:
+                    break
+                docs = []
+                for name, _, body in rows:
+                    if body is None:
+                        self.search.delete_wiki(name)
+                    else:
+                        docs.append((name, json.loads(body)))
+                if docs:
+                    self.search.index_wiki_bulk(docs)
+                db.executemany(
+                    "DELETE FROM queue WHERE name = ? AND seq = ?",
+                    [(name, seq) for name, seq, _ in rows],
+                )
+                count += len(rows)
+        return count
+
+    def start(self):
+        """Drain in a daemon thread every ``interval`` seconds."""
+        self._periodic.start(self.interval)
+
+    def stop(self):
+        """Stop the thread started by :meth:`start`."""
+        self._periodic.stop()
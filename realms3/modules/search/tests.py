@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from nose.tools import *
+from flask import g
+
+from realms3.lib.test import BaseTest
+from realms3.modules.search.commands import _sync
+from realms3.modules.search.models import BaseSearch, SimpleSearch, SqliteSearch
+from realms3.modules.search.queue import IndexQueue
+
+
+class SimpleSearchTest(BaseTest):
+    def setUp(self):
+        self.wiki = g.current_wiki = self.app.extensions["wiki"]
+        self.search = SimpleSearch(content=True)
+
+    def write(self, name, content):
+        self.wiki.commit("test", "test@example.com", "test", {name + ".md": content})
+
+    def names(self, query):
+        return [hit["name"] for hit in self.search.wiki(query)]
+
+    def test_tokens(self):
+        self.write("apple-pie", "sweet")
+        self.write("apple", "sour")
+        eq_(self.names("pie"), ["apple-pie"])
+        eq_(self.names("Apple"), ["apple", "apple-pie"])
+        eq_(self.names("apple sour"), ["apple", "apple-pie"])
+        eq_(self.names("nothing"), [])
+
+    def test_refresh(self):
+        self.write("fruit", "apple")
+        eq_(self.names("apple"), ["fruit"])
+        self.write("fruit", "banana")
+        eq_(self.names("apple"), [])
+        eq_(self.names("banana"), ["fruit"])
+
+    def test_excerpt(self):
+        self.search.excerpt_size = 5
+        self.write("fruit", "apple banana")
+        eq_(self.search.wiki("apple"), [dict(name="fruit", content="apple")])
+        self.search.content = False
+        self.search.delete_index("wiki")
+        eq_(self.search.wiki("fruit"), [dict(name="fruit", content="")])
+
+
+class SqliteSearchTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.search = SqliteSearch(os.path.join(self.tempdir, "search.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def names(self, query):
+        return [hit["name"] for hit in self.search.wiki(query)]
+
+    def test_index(self):
+        self.search.index_wiki("fox", dict(content=b"nothing here"))
+        self.search.index_wiki("story", dict(content="a fox story"))
+        self.search.index_wiki("story", dict(content="a dog story"))
+        eq_(self.names("fox"), ["fox"])
+        eq_(self.names("dog"), ["story"])
+        eq_(self.search.wiki("dog")[0]["content"], "a **dog** story")
+
+    def test_query_quoting(self):
+        self.search.index_wiki("fox", dict(content="quick fox"))
+        eq_(self.names('fox" ('), ["fox"])
+        eq_(self.names("(quick) fox*"), ["fox"])
+        eq_(self.names("***"), [])
+
+    def test_delete(self):
+        self.search.index_wiki_bulk(
+            [("a", dict(content="fox")), ("b", dict(content="fox"))]
+        )
+        self.search.delete_wiki("a")
+        self.search.delete_wiki("missing")
+        eq_(self.names("fox"), ["b"])
+        self.search.delete_index("wiki")
+        eq_(self.names("fox"), [])
+
+    def test_indexed_commit(self):
+        eq_(self.search.indexed_commit(), None)
+        self.search.set_indexed_commit("a" * 40)
+        eq_(self.search.indexed_commit(), "a" * 40)
+        self.search.delete_index("wiki")
+        eq_(self.search.indexed_commit(), None)
+
+
+class SyncIndexTest(BaseTest):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.wiki = self.app.extensions["wiki"]
+        self.search = SqliteSearch(os.path.join(self.tempdir, "search.sqlite"))
+        self.app.extensions["search"] = self.search
+        self.app.extensions.pop("search_queue", None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def names(self, query):
+        return [hit["name"] for hit in self.search.wiki(query)]
+
+    def test_sync_rename(self):
+        self.wiki.commit(
+            "test", "test@example.com", "add", {"a.md": "apple", "c.md": "cherry"}
+        )
+        # Nothing indexed yet, so everything is
+        _sync(self.wiki, 1, 10)
+        eq_(self.names("apple"), ["a"])
+        eq_(self.search.indexed_commit(), self.wiki.history_index.head)
+
+        self.wiki.commit(
+            "test", "test@example.com", "move", {"a.md": None, "b/a.md": "apple"}
+        )
+        _sync(self.wiki, 1, 10)
+        eq_(self.names("apple"), ["b/a"])
+        eq_(self.names("cherry"), ["c"])
+        eq_(self.search.indexed_commit(), self.wiki.history_index.head)
+
+
+class RecordingSearch(BaseSearch):
+    def __init__(self):
+        self.calls = []
+
+    def index_wiki(self, name, body):
+        self.calls.append(("index", name, body["content"]))
+
+    def delete_wiki(self, name):
+        self.calls.append(("delete", name))
+
+
+class IndexQueueTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.search = RecordingSearch()
+        self.queue = IndexQueue(os.path.join(self.tempdir, "queue.sqlite"), self.search)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_coalesces(self):
+        self.queue.index_wiki("a", dict(content=b"1"))
+        self.queue.index_wiki("a", dict(content="2"))
+        self.queue.index_wiki("b", dict(content="b"))
+        self.queue.delete_wiki("b")
+        self.queue.index_wiki("a", dict(content="3"))
+        eq_(len(self.queue), 2)
+
+        eq_(self.queue.drain(), 2)
+        eq_(self.search.calls, [("delete", "b"), ("index", "a", "3")])
+        eq_(len(self.queue), 0)
+
+    def test_queued_again_while_draining(self):
+        index_wiki = self.search.index_wiki
+
+        def requeue(name, body):
+            index_wiki(name, body)
+            if body["content"] == "1":
+                self.queue.index_wiki(name, dict(content="2"))
+
+        self.search.index_wiki = requeue
+        self.queue.index_wiki("a", dict(content="1"))
+        self.queue.drain()
+        eq_(self.search.calls, [("index", "a", "1"), ("index", "a", "2")])
+        eq_(len(self.queue), 0)
@@ -5,14 +5,28 @@ from .models import Wiki
 
 
 def init(app):
-    # Init Wiki
-    Wiki(app.config["WIKI_PATH"])
+    # Init Wiki, shared by every request of this process
+    app.extensions["wiki"] = Wiki(
+        app.config["WIKI_PATH"],
+        blob_cache_size=app.config["WIKI_BLOB_CACHE_SIZE"],
+        tree_cache_size=app.config["WIKI_TREE_CACHE_SIZE"],
+        partials_max_depth=app.config["WIKI_PARTIALS_MAX_DEPTH"],
+        partials_max_pages=app.config["WIKI_PARTIALS_MAX_PAGES"],
+        commit_window=app.config["WIKI_COMMIT_WINDOW"],
+        checkout=app.config["WIKI_CHECKOUT"],
+        max_loose_objects=app.config["WIKI_MAX_LOOSE_OBJECTS"],
+        max_packs=app.config["WIKI_MAX_PACKS"],
+    )
+    if app.config["WIKI_MAINTENANCE_INTERVAL"]:
+        app.extensions["wiki"].maintenance.start(
+            app.config["WIKI_MAINTENANCE_INTERVAL"]
+        )
 
     # Check paths
     for mode in [os.W_OK, os.R_OK]:
         for dir_ in [
             app.config["WIKI_PATH"],
-            os.path.join(app.config["WIKI_PATH"], ".git"),
+            app.extensions["wiki"].repo.controldir(),
         ]:
             if not os.access(dir_, mode):
                 sys.exit("Read and write access to WIKI_PATH is required (%s)" % dir_)
@@ -0,0 +1,48 @@
+import click
+from flask import current_app
+
+from realms3 import cli_group
+from .maintenance import object_stats
+
+
+@cli_group(short_help="Wiki Module")
+def cli():
+    pass
+
+
+@cli.command()
+def rebuild_history():
+    """ Rebuild page history index
+    """
+    wiki = current_app.extensions["wiki"]
+    count = wiki.history_index.rebuild(wiki.repo)
+    click.echo("Indexed {0} commits".format(count))
+
+
+@cli.command()
+@click.option("--force", is_flag=True, help="Repack even if under the thresholds")
+def maintain(force):
+    """Pack loose objects, repack if there are too many packs"""
+    wiki = current_app.extensions["wiki"]
+    report = wiki.maintenance.run(force=force)
+    if report["pruned"]:
+        click.echo("Removed {0} redundant objects and packs".format(report["pruned"]))
+    if not report["action"]:
+        click.echo("Nothing to do")
+    _echo_stats(report["after"])
+
+
+@cli.command()
+def stats():
+    """Show git object store stats"""
+    wiki = current_app.extensions["wiki"]
+    _echo_stats(object_stats(wiki.repo.object_store))
+
+
+def _echo_stats(stats):
+    click.echo(
+        "{loose_count} loose objects ({loose_size} bytes), "
+        "{packed_count} objects in {pack_count} packs ({pack_size} bytes)".format(
+            **stats
+        )
+    )
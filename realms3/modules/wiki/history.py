@@ -0,0 +1,363 @@
+from dulwich.diff_tree import RenameDetector, tree_changes
+
+from realms3.concurrency import LocalConnection, transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS commits (
+    seq INTEGER PRIMARY KEY,
+    sha TEXT UNIQUE NOT NULL,
+    author TEXT,
+    author_email TEXT,
+    time INTEGER,
+    message TEXT
+);
+CREATE TABLE IF NOT EXISTS changes (
+    path TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    type TEXT,
+    old_path TEXT,
+    new_path TEXT,
+    PRIMARY KEY (path, seq)
+);
+CREATE TABLE IF NOT EXISTS paths (
+    path TEXT PRIMARY KEY,
+    first_seq INTEGER NOT NULL,
+    last_seq INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Bump to reindex existing databases when what is indexed changes
+VERSION = "3"
+
+REV_COLUMNS = ("sha", "author", "author_email", "time", "message")
+
+
+def _decode(value):
+    if value is None:
+        return None
+    return value.decode("utf-8", "replace")
+
+
+def make_rev(commit, change=None):
+    """History entry for a commit and the change it made to a page."""
+    author_name, author_email = commit.author.rstrip(b">").split(b"<", 1)
+    return dict(
+        author=_decode(author_name.strip()),
+        author_email=_decode(author_email),
+        time=commit.author_time,
+        message=_decode(commit.message),
+        sha=_decode(commit.id),
+        type=change.type if change else None,
+        new_filename=_decode(change.new.path) if change else None,
+        old_filename=_decode(change.old.path) if change else None,
+    )
+
+
+class HistoryIndex(object):
+    """On-disk index of the commits touching each path.
+
+    Commits are numbered in the order they were indexed, oldest first, and every
+    change is stored under the path(s) it touches, so the history of a page is a
+    range scan instead of a walk over every commit of the repository. Renames are
+    stored under both names, with the old name to keep following.
+
+    The first and last commits touching every current path are kept as well, a
+    renamed path starting where the old one did.
+
+    While history is linear, the commits up to a given one are the ones with a
+    lower or equal number. Past the first commit that isn't a child of the one
+    indexed before it, e.g. a merge pushed to the repository, that no longer holds
+    and :meth:`covers` tells which commits history can be read from here.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = LocalConnection(
+            path, setup=lambda db: db.executescript(SCHEMA)
+        )
+
+    @property
+    def db(self):
+        return self._connection.get()
+
+    def _get_state(self, key):
+        row = self.db.execute(
+            "SELECT value FROM state WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def seq_of(self, sha):
+        """Position of a commit in the index, None if it isn't indexed."""
+        row = self.db.execute(
+            "SELECT seq FROM commits WHERE sha = ?", (sha,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def covers(self, sha):
+        """Whether the history up to a commit can be read from the index.
+
+        :param sha: Commit sha, as text.
+        :return: bool -- False if it isn't indexed, or follows a merge
+
+        """
+        seq = self.seq_of(sha)
+        if seq is None:
+            return False
+        linear = self._get_state("linear")
+        return linear is None or seq <= int(linear)
+
+    def update(self, repo):
+        """Index commits added since the last update.
+
+        :param repo: dulwich.repo.Repo
+        :return: int -- Number of commits indexed
+
+        """
+        try:
+            head = _decode(repo.refs[b"HEAD"])
+        except KeyError:
+            # No commits yet
+            return 0
+        if self._get_state("head") == head and self._get_state("version") == VERSION:
+            return 0
+
+        with transaction(self.db) as db:
+            indexed = self._get_state("head")
+            if self._get_state("version") != VERSION:
+                self._clear()
+                indexed = None
+            elif indexed == head:
+                return 0
+            elif self.seq_of(head) is not None:
+                # HEAD moved back to a commit we indexed, e.g. a reset
+                indexed = self._truncate(head)
+            count = self._index_commits(repo, head, indexed)
+            if count is None:
+                # HEAD doesn't descend from what we indexed, history was rewritten
+                self._clear()
+                count = self._index_commits(repo, head, None)
+            db.execute("INSERT OR REPLACE INTO state VALUES ('version', ?)", (VERSION,))
+        return count
+
+    @property
+    def head(self):
+        """Last commit indexed, as text."""
+        return self._get_state("head")
+
+    def rebuild(self, repo):
+        """Drop the index and build it again from HEAD.
+
+        :param repo: dulwich.repo.Repo
+        :return: int -- Number of commits indexed
+
+        """
+        with transaction(self.db):
+            self._clear()
+        return self.update(repo)
+
+    def _clear(self):
+        for table in ("commits", "changes", "paths", "state"):
+            self.db.execute("DELETE FROM {0}".format(table))
+
+    def _truncate(self, head):
+        """Drop the commits indexed after ``head``, which is indexed.
+
+        :return: str -- ``head`` if it was kept, None if the index was cleared
+
+        """
+        seq = self.seq_of(head)
+        linear = self._get_state("linear")
+        if linear is not None and seq > int(linear):
+            # Commits after it aren't all descendants, start over
+            self._clear()
+            return None
+        db = self.db
+        db.execute("DELETE FROM commits WHERE seq > ?", (seq,))
+        db.execute("DELETE FROM changes WHERE seq > ?", (seq,))
+        db.execute("DELETE FROM state WHERE key = 'linear'")
+        # Replay the changes that are left
+        db.execute("DELETE FROM paths")
+        rows = db.execute(
+            "SELECT DISTINCT seq, type, old_path, new_path FROM changes ORDER BY seq"
+        ).fetchall()
+        for row in rows:
+            self._index_path(*row)
+        db.execute("INSERT OR REPLACE INTO state VALUES ('head', ?)", (head,))
+        return head
+
+    def _index_commits(self, repo, head, indexed):
+        exclude = [indexed.encode()] if indexed else None
+        entries = list(
+            repo.get_walker(include=[head.encode()], exclude=exclude, reverse=True)
+        )
+        previous = indexed.encode() if indexed else None
+        if (
+            entries
+            and previous
+            and not any(previous in e.commit.parents for e in entries)
+        ):
+            # HEAD doesn't descend from what we indexed
+            return None
+        linear = self._get_state("linear") is None
+        detector = RenameDetector(repo.object_store)
+        db = self.db
+        seq = db.execute("SELECT COALESCE(MAX(seq), 0) FROM commits").fetchone()[0]
+        count = 0
+        for entry in entries:
+            commit = entry.commit
+            parent_tree = repo[commit.parents[0]].tree if commit.parents else None
+            if linear and commit.parents != ([previous] if previous else []):
+                linear = False
+                db.execute("INSERT INTO state VALUES ('linear', ?)", (str(seq),))
+            previous = commit.id
+
+            seq += 1
+            count += 1
+            rev = make_rev(commit)
+            db.execute(
+                "INSERT INTO commits VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    seq,
+                    rev["sha"],
+                    rev["author"],
+                    rev["author_email"],
+                    rev["time"],
+                    rev["message"],
+                ),
+            )
+            for change in tree_changes(
+                repo.object_store, parent_tree, commit.tree, rename_detector=detector
+            ):
+                old_path, new_path = _decode(change.old.path), _decode(change.new.path)
+                for path in set(p for p in (old_path, new_path) if p):
+                    db.execute(
+                        "INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?)",
+                        (path, seq, change.type, old_path, new_path),
+                    )
+                self._index_path(seq, change.type, old_path, new_path)
+        db.execute("INSERT OR REPLACE INTO state VALUES ('head', ?)", (head,))
+        return count
+
+    def _index_path(self, seq, type_, old_path, new_path):
+        db = self.db
+        first_seq = seq
+        if type_ in ("delete", "rename"):
+            if type_ == "rename":
+                row = db.execute(
+                    "SELECT first_seq FROM paths WHERE path = ?", (old_path,)
+                ).fetchone()
+                first_seq = row[0] if row else seq
+            db.execute("DELETE FROM paths WHERE path = ?", (old_path,))
+        if new_path:
+            db.execute(
+                "INSERT INTO paths VALUES (?, ?, ?)"
+                " ON CONFLICT (path) DO UPDATE SET last_seq = excluded.last_seq",
+                (new_path, first_seq, seq),
+            )
+
+    def path_revs(self, path=None):
+        """First and last revisions of current paths, as of :attr:`head`.
+
+        :param path: Only this path.
+        :return: dict -- path -> dict of ``first`` and ``last`` revisions
+
+        """
+        columns = ", ".join(
+            "{0}.{1}".format(alias, column)
+            for alias in ("f", "l")
+            for column in REV_COLUMNS
+        )
+        query = (
+            "SELECT p.path, {0} FROM paths p"
+            " JOIN commits f ON f.seq = p.first_seq"
+            " JOIN commits l ON l.seq = p.last_seq".format(columns)
+        )
+        params = ()
+        if path is not None:
+            query += " WHERE p.path = ?"
+            params = (path,)
+        revs = {}
+        size = len(REV_COLUMNS)
+        for row in self.db.execute(query, params):
+            revs[row[0]] = dict(
+                first=dict(zip(REV_COLUMNS, row[1 : size + 1])),
+                last=dict(zip(REV_COLUMNS, row[size + 1 :])),
+            )
+        return revs
+
+    def path_times(self):
+        """Times of the first and last commits of every current path.
+
+        :return: dict -- path -> (ctime, mtime)
+
+        """
+        rows = self.db.execute(
+            "SELECT p.path, f.time, l.time FROM paths p"
+            " JOIN commits f ON f.seq = p.first_seq"
+            " JOIN commits l ON l.seq = p.last_seq"
+        )
+        return dict((path, (ctime, mtime)) for path, ctime, mtime in rows)
+
+    def iter_revs(self, path, start, skip_start=False, end=None):
+        """Revisions touching ``path``, newest first, following renames.
+
+        :param path: File name at ``start``.
+        :param start: Commit sha to start from, must be covered (see :meth:`covers`).
+        :param skip_start: Leave out the start commit itself.
+        :param end: Commit sha to stop at, exclusive.
+        :return: iter -- Iterator over dicts
+
+        """
+        bound = self.seq_of(start)
+        if skip_start:
+            bound -= 1
+        while path:
+            rows = self.db.execute(
+                "SELECT c.seq, c.sha, c.author, c.author_email, c.time, c.message,"
+                " ch.type, ch.old_path, ch.new_path"
+                " FROM changes ch JOIN commits c ON c.seq = ch.seq"
+                " WHERE ch.path = ? AND ch.seq <= ? ORDER BY ch.seq DESC",
+                (path, bound),
+            )
+            next_path = None
+            for seq, sha, author, email, time, message, type_, old, new in rows:
+                if sha == end:
+                    return
+                yield dict(
+                    author=author,
+                    author_email=email,
+                    time=time,
+                    message=message,
+                    sha=sha,
+                    type=type_,
+                    new_filename=new,
+                    old_filename=old,
+                )
+                if type_ == "rename" and new == path:
+                    next_path, bound = old, seq - 1
+                    break
+            path = next_path
+
+    def count_revs(self, path, start):
+        """Number of revisions :meth:`iter_revs` yields from ``start``."""
+        bound = self.seq_of(start)
+        count = 0
+        while path:
+            rename = self.db.execute(
+                "SELECT seq, old_path FROM changes WHERE path = ? AND seq <= ?"
+                " AND type = 'rename' AND new_path = ? ORDER BY seq DESC LIMIT 1",
+                (path, bound, path),
+            ).fetchone()
+            low = rename[0] if rename else 0
+            count += self.db.execute(
+                "SELECT COUNT(*) FROM changes WHERE path = ? AND seq BETWEEN ? AND ?",
+                (path, low, bound),
+            ).fetchone()[0]
+            if not rename:
+                break
+            path, bound = rename[1], rename[0] - 1
+        return count
@@ -1,7 +1,5 @@
 from flask import g, current_app
 
-from .models import Wiki
-
 
 def before_request():
-    g.current_wiki = Wiki(current_app.config["WIKI_PATH"])
+    g.current_wiki = current_app.extensions["wiki"]
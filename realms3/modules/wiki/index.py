@@ -0,0 +1,255 @@
+import base64
+import bisect
+import json
+
+from dulwich.diff_tree import tree_changes
+from six import text_type
+
+from realms3.lib.util import filename_to_cname
+
+SORT_KEYS = ("name", "size", "ctime", "mtime")
+
+
+def encode_cursor(*values):
+    """Opaque, url safe pagination cursor holding JSON serializable values."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode()
+
+
+def decode_cursor(cursor, types):
+    """Values of a cursor made by :func:`encode_cursor`.
+
+    :param cursor: Cursor string.
+    :param types: Expected type of each value.
+    :return: list -- Values, raises ValueError if the cursor is invalid
+
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode("utf-8"))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError("Invalid cursor")
+    for value, type_ in zip(values, types):
+        if not isinstance(value, type_):
+            raise ValueError("Invalid cursor")
+    return values
+
+
+def paginate(rows, sort="name", reverse=False, start=0, length=100, cursor=None):
+    """Get a page of index rows.
+
+    Rows sorted by name are resumed from the cursor with a binary search, so paging
+    stays stable while pages are added or removed; other orders are sorted on the
+    fly and resumed by position.
+
+    :param rows: List of dicts, sorted by name.
+    :param sort: One of ``SORT_KEYS``.
+    :param reverse: Sort descending.
+    :param start: Position of the first row, ignored when a cursor is given.
+    :param length: Number of rows.
+    :param cursor: Cursor returned for a previous page.
+    :return: tuple -- (list of dicts, total rows, cursor of the next page or None)
+
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError("Invalid sort key")
+    total = len(rows)
+    after = None
+    if cursor:
+        start, after = decode_cursor(cursor, (int, text_type))
+    if sort != "name":
+        rows = sorted(rows, key=lambda x: (x[sort], x["name"]), reverse=reverse)
+    elif after is not None and not reverse:
+        lo, hi = 0, total
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if rows[mid]["name"] <= after:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+    elif reverse:
+        rows = rows[::-1]
+    items = rows[start : start + length]
+    next_cursor = None
+    if start + length < total and items:
+        next_cursor = encode_cursor(start + length, items[-1]["name"])
+    return items, total, next_cursor
+
+
+class DirectoryNode(object):
+    """Directory of the page tree with stats rolled up from everything below it."""
+
+    def __init__(self, name=""):
+        self.name = name
+        self.dirs = {}
+        self.pages = []
+        self.size = 0
+        self.count = 0
+        self.ctime = None
+        self.mtime = 0
+        self._listing = None
+
+    def add(self, entry, parts):
+        self.size += entry["size"]
+        self.count += 1
+        self.mtime = max(self.mtime, entry["mtime"])
+        if self.ctime is None or entry["ctime"] < self.ctime:
+            self.ctime = entry["ctime"]
+        if len(parts) == 1:
+            self.pages.append(entry)
+            return
+        node = self.dirs.get(parts[0])
+        if node is None:
+            node = self.dirs[parts[0]] = DirectoryNode(self.name + parts[0] + "/")
+        node.add(entry, parts[1:])
+
+    def lookup(self, path):
+        """Get the node of a directory.
+
+        :param path: Directory path, with or without a trailing slash.
+        :return: DirectoryNode or None
+
+        """
+        node = self
+        for part in path.strip("/").split("/") if path.strip("/") else []:
+            node = node.dirs.get(part)
+            if node is None:
+                return None
+        return node
+
+    def listing(self):
+        """Pages and subdirectories directly in this directory, sorted by name.
+
+        :return: list -- List of dicts
+
+        """
+        if self._listing is None:
+            items = [dict(page, dir=False) for page in self.pages]
+            items.extend(
+                dict(
+                    name=node.name,
+                    mtime=node.mtime,
+                    ctime=node.ctime,
+                    size=node.size,
+                    count=node.count,
+                    dir=True,
+                )
+                for node in self.dirs.values()
+            )
+            self._listing = sorted(items, key=lambda x: x["name"])
+        return self._listing
+
+
+class IndexSnapshot(object):
+    """Parsed git index, shared by every request until the index file changes.
+
+    Wikis without a working tree have no index, their snapshots are made from the
+    tree of HEAD instead, see :meth:`from_tree`.
+
+    :param index: dulwich.index.Index, or None for an empty snapshot
+    :param key: Stat info of the index file the snapshot was parsed from
+    :param times: Times of the first and last commits of each path, preferred over
+        the working tree times of the index, which are reset by a clone.
+
+    """
+
+    def __init__(self, index=None, key=None, times=None):
+        self.key = key
+        self.tree_id = None
+        entries = {}
+        times = times or {}
+        if index is not None:
+            for path, entry in index.iteritems():
+                filename = path.decode("utf-8")
+                ctime, mtime = times.get(filename, (entry.ctime[0], entry.mtime[0]))
+                entries[filename] = dict(
+                    name=filename_to_cname(filename),
+                    filename=filename,
+                    ctime=ctime,
+                    mtime=mtime,
+                    sha=entry.sha,
+                    size=entry.size,
+                )
+        self._set_entries(entries)
+
+    def _set_entries(self, entries):
+        self._entries = entries
+        self.entries = sorted(entries.values(), key=lambda x: x["name"])
+        self._names = [entry["name"] for entry in self.entries]
+        self._tree = None
+
+    def from_tree(self, object_store, tree_id, key, times=None):
+        """Snapshot of a commit tree, reusing the entries of this snapshot.
+
+        When this snapshot was made from a tree as well, only the differences
+        between the two trees are read.
+
+        :param object_store: Object store of the repository.
+        :param tree_id: Tree sha, None for an empty snapshot.
+        :param key: Key of the new snapshot, usually the commit id.
+        :param times: Times of the first and last commits of each path.
+        :return: IndexSnapshot
+
+        """
+        times = times or {}
+        old_tree = self.tree_id
+        entries = dict(self._entries) if old_tree else {}
+        for change in tree_changes(object_store, old_tree, tree_id):
+            if change.old.path:
+                entries.pop(change.old.path.decode("utf-8"), None)
+            if change.new.path:
+                filename = change.new.path.decode("utf-8")
+                ctime, mtime = times.get(filename, (0, 0))
+                entries[filename] = dict(
+                    name=filename_to_cname(filename),
+                    filename=filename,
+                    ctime=ctime,
+                    mtime=mtime,
+                    sha=change.new.sha,
+                    size=len(object_store[change.new.sha].data),
+                )
+        snapshot = IndexSnapshot(key=key)
+        snapshot.tree_id = tree_id
+        snapshot._set_entries(entries)
+        return snapshot
+
+    def __contains__(self, filename):
+        return filename in self._entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename):
+        return self._entries.get(filename)
+
+    @property
+    def tree(self):
+        """Directory tree of the snapshot, built on first use.
+
+        :return: DirectoryNode
+
+        """
+        if self._tree is None:
+            tree = DirectoryNode()
+            for entry in self.entries:
+                tree.add(entry, entry["name"].split("/"))
+            self._tree = tree
+        return self._tree
+
+    def prefixed(self, prefix):
+        """Entries whose name starts with ``prefix``, sorted by name.
+
+        :return: list -- List of dicts
+
+        """
+        if not prefix:
+            return list(self.entries)
+        start = bisect.bisect_left(self._names, prefix)
+        end = bisect.bisect_left(
+            self._names, prefix[:-1] + chr(ord(prefix[-1]) + 1), start
+        )
+        return self.entries[start:end]
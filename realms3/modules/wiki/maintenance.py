@@ -0,0 +1,272 @@
+import logging
+import os
+from collections import deque
+
+from dulwich.objects import hex_to_sha
+from dulwich.pack import DEFAULT_PACK_DELTA_WINDOW_SIZE, create_delta, write_pack_data
+
+from realms3.concurrency import FileLock, Periodic
+
+logger = logging.getLogger(__name__)
+
+# Packs left over by a repack, removed by the next maintenance run
+REDUNDANT_PACKS = "realms3-redundant"
+
+
+def object_stats(object_store):
+    """Counts and sizes of the objects of a repository.
+
+    :param object_store: dulwich.object_store.DiskObjectStore
+    :return: dict
+
+    """
+    loose_count = loose_size = 0
+    for base in os.listdir(object_store.path):
+        if len(base) != 2:
+            continue
+        base = os.path.join(object_store.path, base)
+        for name in os.listdir(base):
+            loose_count += 1
+            loose_size += os.path.getsize(os.path.join(base, name))
+
+    pack_count = pack_size = packed_count = 0
+    for pack in object_store.packs:
+        pack_count += 1
+        packed_count += len(pack.index)
+        pack_size += os.path.getsize(pack._data_path)
+    return dict(
+        loose_count=loose_count,
+        loose_size=loose_size,
+        pack_count=pack_count,
+        packed_count=packed_count,
+        pack_size=pack_size,
+    )
+
+
+def _redundant_path(object_store):
+    return os.path.join(object_store.path, REDUNDANT_PACKS)
+
+
+def _read_redundant(object_store):
+    try:
+        with open(_redundant_path(object_store)) as f:
+            return set(f.read().split())
+    except IOError:
+        return set()
+
+
+def _write_redundant(object_store, names):
+    path = _redundant_path(object_store)
+    if not names:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path + ".tmp", "w") as f:
+        f.write("\n".join(sorted(names)))
+    os.replace(path + ".tmp", path)
+
+
+def _pack_records(object_store, keys, window_size):
+    """Records of sorted objects for ``write_pack_data``, deltified.
+
+    Like dulwich's ``deltify_pack_objects``, objects are tried as deltas of the
+    ones before them, but only those in the window are kept in memory.
+
+    :param keys: Sorted list of (type, path, -size, sha) tuples.
+
+    """
+    window = deque(maxlen=window_size)
+    for type_num, _, _, sha in keys:
+        raw = object_store.get_raw(sha)[1]
+        winner, winner_base = raw, None
+        for base_type, base_id, base_raw in window:
+            if base_type != type_num:
+                continue
+            delta = create_delta(base_raw, raw)
+            if len(delta) < len(winner):
+                winner, winner_base = delta, base_id
+        object_id = hex_to_sha(sha)
+        yield type_num, object_id, winner_base, winner
+        window.appendleft((type_num, object_id, raw))
+
+
+def _write_pack(object_store, objects, delta_window_size=None):
+    """Write objects to a new pack, with delta compression.
+
+    :param objects: Iterable of (sha, path) tuples, objects being read once to
+        sort them and once to write them, so that they aren't all in memory.
+    :return: dulwich.pack.Pack -- None if it wasn't written
+
+    """
+    keys = []
+    for sha, path in objects:
+        type_num, raw = object_store.get_raw(sha)
+        # The root tree's path is "", subtree paths are bytes, commits have none
+        if not isinstance(path, bytes):
+            path = (path or "").encode("utf-8")
+        keys.append((type_num, path, -len(raw), sha))
+    keys.sort()
+    window_size = delta_window_size or DEFAULT_PACK_DELTA_WINDOW_SIZE
+
+    f, commit, abort = object_store.add_pack()
+    try:
+        write_pack_data(f, len(keys), _pack_records(object_store, keys, window_size))
+    except BaseException:
+        abort()
+        raise
+    pack = commit()
+    if pack is not None:
+        # Written again, so no longer redundant
+        redundant = _read_redundant(object_store)
+        name = os.path.basename(pack._basename)
+        if name in redundant:
+            _write_redundant(object_store, redundant - {name})
+    return pack
+
+
+def prune(object_store):
+    """Remove loose objects that are packed, and packs left over by a repack.
+
+    Packing and repacking never remove anything themselves: a reader that
+    scanned the packs just before a new pack was added still looks for its
+    objects in the old places, so those are only removed by the next run.
+
+    :param object_store: dulwich.object_store.DiskObjectStore
+    :return: int -- Number of loose objects and packs removed
+
+    """
+    removed = 0
+    redundant = _read_redundant(object_store)
+    for pack in list(object_store.packs):
+        if os.path.basename(pack._basename) in redundant:
+            for ext in (".pack", ".idx"):
+                os.remove(pack._basename + ext)
+            removed += 1
+    _write_redundant(object_store, set())
+    if removed:
+        # Don't wait for the pack directory mtime to tell
+        object_store._update_pack_cache()
+    for sha in list(object_store._iter_loose_objects()):
+        if object_store.contains_packed(sha):
+            object_store._remove_loose_object(sha)
+            removed += 1
+    return removed
+
+
+def pack_loose_objects(object_store, delta_window_size=None):
+    """Copy loose objects that aren't packed yet to a new pack, with delta compression.
+
+    The loose copies are removed by the next :func:`prune`.
+
+    :param object_store: dulwich.object_store.DiskObjectStore
+    :param delta_window_size: Objects to try as delta bases for each object.
+    :return: int -- Number of objects packed
+
+    """
+    shas = [
+        sha
+        for sha in object_store._iter_loose_objects()
+        if not object_store.contains_packed(sha)
+    ]
+    if not shas:
+        return 0
+    _write_pack(
+        object_store, [(sha, None) for sha in shas], delta_window_size=delta_window_size
+    )
+    return len(shas)
+
+
+def repack(repo, delta_window_size=None):
+    """Write every object reachable from the refs to a single pack.
+
+    Previous packs are left for the next :func:`prune` to remove, which drops
+    unreachable objects. Objects are written with their paths, so versions of
+    the same page are tried as delta bases for each other.
+
+    :param repo: dulwich.repo.Repo
+    :param delta_window_size: Objects to try as delta bases for each object.
+    :return: int -- Number of objects packed
+
+    """
+    object_store = repo.object_store
+    heads = set(sha for sha in repo.refs.as_dict().values())
+    if not heads:
+        return 0
+    old_packs = [os.path.basename(pack._basename) for pack in object_store.packs]
+    objects = list(object_store.find_missing_objects([], list(heads)))
+    pack = _write_pack(object_store, objects, delta_window_size=delta_window_size)
+
+    redundant = _read_redundant(object_store).union(old_packs)
+    if pack is not None:
+        redundant.discard(os.path.basename(pack._basename))
+    _write_redundant(object_store, redundant)
+    return len(objects)
+
+
+class Maintenance(object):
+    """Keeps the object store of a wiki packed.
+
+    Every save adds loose objects, which slow down lookups and backups once
+    there are many of them. Loose objects are packed once there are more than
+    ``max_loose``, and everything is repacked into one pack once there are more
+    than ``max_packs`` packs. What that makes redundant is removed by the next
+    run.
+
+    Saves go on meanwhile: they only ever add loose objects, which a pack being
+    written leaves alone, and everything reachable when a repack starts is in the
+    new pack. Runs hold a lock file of their own so that one process at a time
+    maintains the repository.
+
+    :param wiki: Wiki
+    :param max_loose: Loose objects allowed before packing them.
+    :param max_packs: Packs allowed before repacking.
+
+    """
+
+    def __init__(self, wiki, max_loose=1000, max_packs=20):
+        self.wiki = wiki
+        self.lock = FileLock(
+            os.path.join(wiki.repo.controldir(), "realms3-maintenance.lock")
+        )
+        self.max_loose = max_loose
+        self.max_packs = max_packs
+        self._periodic = Periodic(self._run_and_log, "wiki-maintenance")
+
+    def run(self, force=False):
+        """Pack or repack when over the thresholds.
+
+        :param force: Repack everything whatever the thresholds.
+        :return: dict -- Object stats before and after, what was done, and how
+            many redundant loose objects and packs were removed first
+
+        """
+        with self.lock.locked():
+            repo = self.wiki.repo
+            pruned = prune(repo.object_store)
+            before = object_stats(repo.object_store)
+            action = None
+            if force or before["pack_count"] > self.max_packs:
+                action = "repack"
+                repack(repo)
+            elif before["loose_count"] > self.max_loose:
+                action = "pack"
+                pack_loose_objects(repo.object_store)
+            after = object_stats(repo.object_store) if action else before
+        return dict(action=action, pruned=pruned, before=before, after=after)
+
+    def _run_and_log(self):
+        report = self.run()
+        if report["action"]:
+            logger.info("Wiki maintenance: %s %s", report["action"], report)
+
+    def start(self, interval):
+        """Run in a daemon thread every ``interval`` seconds.
+
+        :param interval: Seconds between runs.
+
+        """
+        self._periodic.start(interval)
+
+    def stop(self):
+        """Stop the thread started by :meth:`start`."""
+        self._periodic.stop()
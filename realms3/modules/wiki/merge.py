@@ -0,0 +1,78 @@
+from difflib import SequenceMatcher
+
+
+def _intersect(ra, rb):
+    start, end = max(ra[0], rb[0]), min(ra[1], rb[1])
+    if start < end:
+        return start, end
+    return None
+
+
+def _sync_regions(base, a, b):
+    """Regions where ``base``, ``a`` and ``b`` all agree.
+
+    :return: list -- (base start, base end, a start, a end, b start, b end) tuples,
+        ending with an empty region at the end of all three
+
+    """
+    a_matches = SequenceMatcher(None, base, a, autojunk=False).get_matching_blocks()
+    b_matches = SequenceMatcher(None, base, b, autojunk=False).get_matching_blocks()
+    regions = []
+    ia = ib = 0
+    while ia < len(a_matches) and ib < len(b_matches):
+        a_base, a_start, a_len = a_matches[ia]
+        b_base, b_start, b_len = b_matches[ib]
+        both = _intersect((a_base, a_base + a_len), (b_base, b_base + b_len))
+        if both:
+            start, end = both
+            a_sub = a_start + start - a_base
+            b_sub = b_start + start - b_base
+            regions.append(
+                (start, end, a_sub, a_sub + end - start, b_sub, b_sub + end - start)
+            )
+        if a_base + a_len < b_base + b_len:
+            ia += 1
+        else:
+            ib += 1
+    regions.append((len(base), len(base), len(a), len(a), len(b), len(b)))
+    return regions
+
+
+def merge3(base, ours, theirs):
+    """Three-way merge of texts, line by line.
+
+    Hunks changed on one side only are taken from that side; hunks changed on both
+    sides conflict unless both made the same change.
+
+    :param base: Common ancestor.
+    :param ours: Our version.
+    :param theirs: Their version.
+    :return: tuple -- (merged text, number of conflicting hunks), merged text is
+        None if there were conflicts
+
+    """
+    base_lines = base.splitlines(True)
+    our_lines = ours.splitlines(True)
+    their_lines = theirs.splitlines(True)
+
+    merged = []
+    conflicts = 0
+    iz = ia = ib = 0
+    for z_start, z_end, a_start, a_end, b_start, b_end in _sync_regions(
+        base_lines, our_lines, their_lines
+    ):
+        base_chunk = base_lines[iz:z_start]
+        our_chunk = our_lines[ia:a_start]
+        their_chunk = their_lines[ib:b_start]
+        if our_chunk == their_chunk or their_chunk == base_chunk:
+            merged.extend(our_chunk)
+        elif our_chunk == base_chunk:
+            merged.extend(their_chunk)
+        else:
+            conflicts += 1
+        merged.extend(base_lines[z_start:z_end])
+        iz, ia, ib = z_end, a_end, b_end
+
+    if conflicts:
+        return None, conflicts
+    return ours[:0].join(merged), 0
@@ -0,0 +1,109 @@
+import re
+import threading
+
+import yaml
+from six import string_types
+
+META_END = re.compile(rb"\n(\.{3}|\-{3})")
+
+_SCALARS = string_types + (bool, int, float)
+
+
+def parse_meta(content):
+    """Get metadata from page if any.
+
+    :param content: Page content
+    :return: dict
+
+    """
+    if not content.startswith(b"---"):
+        return None
+
+    meta_end = META_END.search(content)
+
+    if not meta_end:
+        return None
+
+    try:
+        meta = yaml.safe_load(content[0 : meta_end.start()])
+    except Exception as e:
+        return {"error": str(e)}
+    return meta if isinstance(meta, dict) else None
+
+
+def _terms(meta):
+    """(key, value) pairs a page is indexed under, value None for the key alone."""
+    for key, value in meta.items():
+        if not isinstance(key, string_types):
+            continue
+        yield key, None
+        values = value if isinstance(value, list) else [value]
+        for value in values:
+            if isinstance(value, _SCALARS):
+                yield key, value
+
+
+class MetaIndex(object):
+    """Front matter of the pages in the git index, queryable by key and value.
+
+    Kept in step with the index snapshot: on refresh only entries whose blob sha
+    changed are looked up again, and parsing itself is cached per blob sha.
+    """
+
+    def __init__(self, get_meta):
+        self.get_meta = get_meta
+        self.key = None
+        self._shas = {}
+        self._terms = {}
+        self._postings = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, snapshot):
+        """Bring the index up to date with an index snapshot.
+
+        :param snapshot: IndexSnapshot
+
+        """
+        if self.key == snapshot.key and self.key is not None:
+            return
+        with self._lock:
+            if self.key == snapshot.key and self.key is not None:
+                return
+            for filename in list(self._shas):
+                if filename not in snapshot:
+                    self._remove(filename)
+            for entry in snapshot:
+                filename = entry["filename"]
+                if self._shas.get(filename) == entry["sha"]:
+                    continue
+                self._remove(filename)
+                self._add(entry)
+            self.key = snapshot.key
+
+    def _add(self, entry):
+        filename = entry["filename"]
+        terms = set(_terms(self.get_meta(entry["sha"]) or {}))
+        for term in terms:
+            self._postings.setdefault(term, {})[filename] = entry["name"]
+        self._shas[filename] = entry["sha"]
+        self._terms[filename] = terms
+
+    def _remove(self, filename):
+        self._shas.pop(filename, None)
+        for term in self._terms.pop(filename, ()):
+            names = self._postings[term]
+            del names[filename]
+            if not names:
+                del self._postings[term]
+
+    def find(self, key, value=None):
+        """Names of pages with a front matter key, sorted.
+
+        :param key: Front matter key.
+        :param value: Only pages where the key is, or is a list containing, this value.
+        :return: list
+
+        """
+        with self._lock:
+            names = list(self._postings.get((key, value), {}).values())
+        return sorted(names)
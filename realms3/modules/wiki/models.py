@@ -1,61 +1,401 @@
+import itertools
+import logging
 import os
-import posixpath
 import re
+import threading
+import time
 
 import ghdiff
-import yaml
-from dulwich.object_store import tree_lookup_path
+from dulwich.index import index_entry_from_stat
+from dulwich.objects import Blob, Commit, Tree
 from dulwich.repo import Repo, NotGitRepository
 from six import text_type
 
 from realms3 import cache
 from realms3.lib.hook import HookMixin
 from realms3.lib.util import cname_to_filename, filename_to_cname
+from .caches import LRUCache
+from .history import HistoryIndex, make_rev
+from .index import IndexSnapshot, decode_cursor, encode_cursor
+from .maintenance import Maintenance
+from .merge import merge3
+from .meta import MetaIndex, parse_meta
+from .partials import ImportGraph
+from .writes import WriteCoordinator, update_tree
+
+logger = logging.getLogger(__name__)
+
+
+def _local_timezone(timestamp):
+    """Offset of local time from UTC at a time, in seconds, as git records it."""
+    local = time.localtime(timestamp)
+    if local.tm_isdst > 0 and time.daylight:
+        return -time.altzone
+    return -time.timezone
 
 
 class PageNotFound(Exception):
     pass
 
 
+class PageConflict(Exception):
+    pass
+
+
+class PageChanged(PageConflict):
+    """A page wasn't at the expected blob when committing."""
+
+
 class Wiki(HookMixin):
+    """Wiki stored in a git repository.
+
+    Commits are written straight to the object store. With ``checkout``, the
+    pages they change are also written to the working tree and the git index,
+    otherwise the repository can be bare.
+
+    """
+
     path = None
     base_path = "/"
     default_ref = "master"
     default_committer_name = "Anon"
     default_committer_email = "anon@anon.anon"
     index_page = "home"
-    repo = None
 
-    def __init__(self, path):
+    def __init__(
+        self,
+        path,
+        blob_cache_size=64 * 1024 * 1024,
+        tree_cache_size=32 * 1024 * 1024,
+        path_cache_entries=100000,
+        partials_max_depth=5,
+        partials_max_pages=50,
+        commit_window=0,
+        checkout=True,
+        max_loose_objects=1000,
+        max_packs=20,
+    ):
         try:
-            self.repo = Repo(path)
+            repo = Repo(path)
         except NotGitRepository:
-            self.repo = Repo.init(path, mkdir=True)
+            if checkout:
+                repo = Repo.init(path, mkdir=True)
+            else:
+                repo = Repo.init_bare(path, mkdir=True)
             # TODO add first commit here
 
         self.path = path
+        self.checkout = checkout and not repo.bare
+        self._local = threading.local()
+        self._local.repo = repo
+        self.blob_cache = LRUCache(blob_cache_size)
+        self.tree_cache = LRUCache(tree_cache_size, sizeof=lambda t: t.raw_length())
+        self.path_cache = LRUCache(path_cache_entries, sizeof=lambda entry: 1)
+        self.meta_cache = LRUCache(path_cache_entries, sizeof=lambda meta: 1)
+        self.meta_index = MetaIndex(self.get_meta)
+        self._index = IndexSnapshot()
+        self._index_lock = threading.Lock()
+        self.history_index = HistoryIndex(
+            os.path.join(repo.controldir(), "realms3-history.sqlite")
+        )
+        self.import_graph = ImportGraph(
+            max_depth=partials_max_depth, max_pages=partials_max_pages
+        )
+        self.writes = WriteCoordinator(
+            os.path.join(repo.controldir(), "realms3-write.lock"),
+            window=commit_window,
+            before_batch=self._begin_batch,
+            after_batch=self._end_batch,
+        )
+        self._batch = None
+        self._stale_paths = set()
+        self.maintenance = Maintenance(
+            self, max_loose=max_loose_objects, max_packs=max_packs
+        )
+
+    @property
+    def repo(self):
+        """Repo handle owned by the calling thread.
+
+        A Wiki is meant to live for the whole process. Dulwich pack files are read
+        through shared file handles, so every thread gets its own ``Repo``; each one
+        keeps its pack indexes open and only rescans the pack directory when its
+        mtime changes.
+
+        :return: dulwich.repo.Repo
+
+        """
+        repo = getattr(self._local, "repo", None)
+        if repo is None:
+            repo = self._local.repo = Repo(self.path)
+        return repo
 
     def __repr__(self):
         return "Wiki: {0}".format(self.path)
 
-    def commit(self, name, email, message, files):
+    def commit(self, name, email, message, changes, expected=None):
         """Commit to the underlying git repo.
 
+        Commits go through :attr:`writes`, so concurrent ones are serialised and
+        committed in batches, HEAD moving once per batch.
+
         :param name: Committer name
         :param email: Committer email
         :param message: Commit message
-        :param files: list of file names that will be staged for commit
-        :return:
+        :param changes: dict of file names to their new content, None to delete
+        :param expected: dict of file names to the blob sha they must have when
+            committing, None if they must not exist; raises PageChanged otherwise
+        :return: bytes -- Commit sha1, None if nothing changed
         """
-        if isinstance(name, text_type):
-            name = name.encode("utf-8")
-        if isinstance(email, text_type):
-            email = email.encode("utf-8")
+        if isinstance(name, bytes):
+            name = name.decode("utf-8")
+        if isinstance(email, bytes):
+            email = email.decode("utf-8")
         if isinstance(message, text_type):
             message = message.encode("utf-8")
-        author = committer = "{0} <{1}>".format(name, email).encode()
-        self.repo.stage(files)
-        return self.repo.do_commit(message=message, committer=committer, author=author)
+        author = "{0} <{1}>".format(name, email).encode("utf-8")
+
+        return self.writes.submit(
+            lambda: self._commit_changes(changes, message, author, expected)
+        )
+
+    def _begin_batch(self):
+        try:
+            head = self.repo.refs[b"HEAD"]
+        except KeyError:
+            # No commits yet
+            head = None
+        self._batch = dict(head=head, tip=head, paths={})
+
+    def _changed_entries(self, commit_id, changes):
+        """Tree entries for the changes that differ from a commit.
+
+        :param commit_id: Commit id, None for an empty repository.
+        :param changes: dict of file names to their new content, None to delete
+        :return: tuple -- (entries, blobs), entries being path (bytes) to
+            (mode, blob sha) or None if deleted, and blobs the new blobs they use
+
+        """
+        entries, blobs = {}, []
+        for filename, content in changes.items():
+            path = filename.encode("utf-8")
+            current = self._blob_sha_at(commit_id, filename)
+            if content is None:
+                if current is not None:
+                    entries[path] = None
+                continue
+            if isinstance(content, text_type):
+                content = content.encode("utf-8")
+            blob = Blob.from_string(content)
+            if blob.id != current:
+                entries[path] = (0o100644, blob.id)
+                blobs.append(blob)
+        return entries, blobs
+
+    def _blob_sha_at(self, commit_id, filename):
+        if commit_id is None:
+            return None
+        try:
+            return self.lookup_path(commit_id, filename.encode("utf-8"))[1]
+        except KeyError:
+            return None
+
+    def _commit_changes(self, changes, message, author, expected=None):
+        batch = self._batch
+        object_store = self.repo.object_store
+        for filename, blob_sha in (expected or {}).items():
+            if self._blob_sha_at(batch["tip"], filename) != blob_sha:
+                raise PageChanged(filename_to_cname(filename))
+        entries, blobs = self._changed_entries(batch["tip"], changes)
+        if not entries:
+            # Content is already there
+            return None
+        for blob in blobs:
+            object_store.add_object(blob)
+
+        tree_id = self.repo[batch["tip"]].tree if batch["tip"] else None
+        tree_id = update_tree(object_store, tree_id, entries)
+        if tree_id is None:
+            tree = Tree()
+            object_store.add_object(tree)
+            tree_id = tree.id
+
+        commit = Commit()
+        commit.tree = tree_id
+        commit.parents = [batch["tip"]] if batch["tip"] else []
+        commit.author = commit.committer = author
+        now = int(time.time())
+        commit.author_time = commit.commit_time = now
+        commit.author_timezone = commit.commit_timezone = _local_timezone(now)
+        commit.message = message
+        object_store.add_object(commit)
+
+        batch["tip"] = commit.id
+        batch["paths"].update(entries)
+        return commit.id
+
+    def _end_batch(self):
+        batch, self._batch = self._batch, None
+        if batch["tip"] == batch["head"]:
+            return
+        if not self.repo.refs.set_if_equals(b"HEAD", batch["head"], batch["tip"]):
+            raise RuntimeError("HEAD was moved by another writer")
+        # The writes are in, what follows only catches up with them
+        if self.checkout:
+            paths = batch["paths"]
+            for path in self._stale_paths - set(paths):
+                try:
+                    paths[path] = self.lookup_path(batch["tip"], path)
+                except KeyError:
+                    paths[path] = None
+            try:
+                self._checkout(paths)
+                self._stale_paths = set()
+            except Exception:
+                # Retried with the next batch
+                self._stale_paths = set(paths)
+                logger.exception("Checking out %d changed paths failed", len(paths))
+        try:
+            self.history_index.update(self.repo)
+        except Exception:
+            # Reads update it as well
+            logger.exception("Updating the history index failed")
+
+    def _checkout(self, paths):
+        """Write changed paths to the working tree and the git index.
+
+        :param paths: dict -- path (bytes) -> (mode, blob sha), or None if deleted
+
+        """
+        index = self.repo.open_index()
+        for path, entry in paths.items():
+            fs_path = os.path.join(self.path, path.decode("utf-8"))
+            if entry is None:
+                try:
+                    del index[path]
+                except KeyError:
+                    pass
+                if os.path.exists(fs_path):
+                    os.remove(fs_path)
+                continue
+            dirname = os.path.dirname(fs_path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(fs_path, "wb") as f:
+                f.write(self.repo.object_store[entry[1]].data)
+            index[path] = index_entry_from_stat(os.lstat(fs_path), entry[1], 0)
+        index.write()
+
+    def get_blob(self, sha):
+        """Get blob content by object sha.
+
+        Blobs are immutable, so their content is kept in a process wide LRU
+        cache bounded by total size and never has to be invalidated.
+
+        :param sha: Blob sha.
+        :return: bytes
+
+        """
+        data = self.blob_cache.get(sha)
+        if data is None:
+            data = self.repo[sha].data
+            self.blob_cache.set(sha, data)
+        return data
+
+    def get_meta(self, sha):
+        """Get the front matter of a blob, parsed once per sha.
+
+        The result is shared and must not be modified.
+
+        :param sha: Blob sha.
+        :return: dict -- None if the blob has no front matter
+
+        """
+        meta = self.meta_cache.get(sha, False)
+        if meta is False:
+            meta = parse_meta(self.get_blob(sha))
+            self.meta_cache.set(sha, meta)
+        return meta
+
+    def get_tree(self, sha):
+        """Get a parsed tree object by sha, cached like blobs.
+
+        :param sha: Tree sha.
+        :return: dulwich.objects.Tree
+
+        """
+        tree = self.tree_cache.get(sha)
+        if tree is None:
+            tree = self.repo[sha]
+            self.tree_cache.set(sha, tree)
+        return tree
+
+    def lookup_path(self, commit_id, path):
+        """Resolve a path in the tree of a commit.
+
+        Results, including misses, are memoised per commit, and the trees walked
+        through are kept parsed, so lookups in the same commit or in unchanged
+        directories of other commits don't touch the object store.
+
+        :param commit_id: Commit id, not a ref.
+        :param path: Path in the tree, as bytes.
+        :return: tuple -- (mode, sha), raises KeyError if the path doesn't exist
+
+        """
+        key = (commit_id, path)
+        entry = self.path_cache.get(key)
+        if entry is None:
+            try:
+                mode, sha = None, self.repo[commit_id].tree
+                for part in path.split(b"/"):
+                    if part:
+                        mode, sha = self.get_tree(sha)[part]
+                entry = mode, sha
+            except (KeyError, TypeError):
+                # TypeError: A blob on the way, not a tree
+                entry = None, None
+            self.path_cache.set(key, entry)
+        if entry[1] is None:
+            raise KeyError(path)
+        return entry
+
+    def resolve(self, sha="HEAD"):
+        """Resolve a ref or commit sha to a commit id.
+
+        :param sha: Ref name or commit sha.
+        :return: bytes -- Commit id, raises KeyError if it doesn't exist
+
+        """
+        if isinstance(sha, text_type):
+            sha = sha.encode("latin-1")
+        if sha == b"HEAD" or sha.startswith(b"refs/"):
+            try:
+                return self.repo.refs[sha]
+            except UnicodeDecodeError:
+                raise KeyError(sha)
+        if not re.match(b"^[0-9a-f]{40}$", sha):
+            raise KeyError(sha)
+        return self.repo[sha].id
+
+    def snapshot(self, sha="HEAD"):
+        """Get a view of the wiki pinned to one commit.
+
+        Meant to live for a request: ``sha`` is resolved once, and pages are
+        memoised, so a page and its partials all render from the same commit while
+        other writes land.
+
+        :param sha: Commit sha or ref.
+        :return: WikiSnapshot
+
+        """
+        try:
+            commit_id = self.resolve(sha)
+        except KeyError:
+            if sha != "HEAD":
+                raise
+            # No commits yet
+            commit_id = None
+        return WikiSnapshot(self, commit_id)
 
     def get_page(self, name, sha="HEAD"):
         """Get page data, partials, commit info.
@@ -67,51 +407,300 @@ class Wiki(HookMixin):
         """
         return WikiPage(name, self, sha=sha)
 
+    @property
+    def index(self):
+        """Snapshot of the git index.
+
+        It is parsed once and reused by every thread until the index file is
+        replaced, which git does on every write. Without a working tree, it is
+        made from the tree of HEAD instead and follows HEAD. Times are those of
+        the first and last commits touching each page.
+
+        :return: IndexSnapshot
+
+        """
+        if not self.checkout:
+            return self._tree_index()
+        try:
+            st = os.stat(self.repo.index_path())
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            key = None
+        if self._index.key != key:
+            with self._index_lock:
+                if self._index.key != key:
+                    index = times = None
+                    if key:
+                        index = self.repo.open_index()
+                        self.history_index.update(self.repo)
+                        times = self.history_index.path_times()
+                    self._index = IndexSnapshot(index, key, times)
+        return self._index
+
+    def _tree_index(self):
+        try:
+            key = self.repo.refs[b"HEAD"]
+        except KeyError:
+            # No commits yet
+            key = None
+        if self._index.key != key:
+            with self._index_lock:
+                if self._index.key != key:
+                    tree_id = times = None
+                    if key:
+                        tree_id = self.repo[key].tree
+                        self.history_index.update(self.repo)
+                        times = self.history_index.path_times()
+                    self._index = self._index.from_tree(
+                        self.repo.object_store, tree_id, key, times
+                    )
+        return self._index
+
+    def find_pages(self, key, value=None):
+        """Find pages by front matter, as of the git index.
+
+        :param key: Front matter key, e.g. ``tags``.
+        :param value: Only pages where the key is, or is a list containing, this value.
+        :return: list -- Page names, sorted
+
+        """
+        self.meta_index.refresh(self.index)
+        return self.meta_index.find(key, value)
+
     def get_index(self):
-        """Get repo index of head.
+        """Get repo index of head, sorted by name.
+
+        Entries are shared with other requests and must not be modified.
 
         :return: list -- List of dicts
 
         """
-        rv = []
-        index = self.repo.open_index()
-        for name in index:
-            rv.append(
-                dict(
-                    name=filename_to_cname(name),
-                    filename=name,
-                    ctime=index[name].ctime[0],
-                    mtime=index[name].mtime[0],
-                    sha=index[name].sha,
-                    size=index[name].size,
-                )
+        return list(self.index)
+
+    def transaction(self):
+        """Start changing several pages in a single commit.
+
+        :return: WikiTransaction
+
+        """
+        return WikiTransaction(self)
+
+
+class WikiSnapshot(object):
+    def __init__(self, wiki, commit_id):
+        self.wiki = wiki
+        self.commit_id = commit_id
+        self._pages = {}
+
+    def get_page(self, name):
+        """Get a page at the snapshot's commit, memoised for the snapshot's life.
+
+        :param name: Name of page.
+        :return: WikiPage
+
+        """
+        page = self._pages.get(name)
+        if page is None:
+            if self.commit_id is None:
+                page = WikiPage(name, self.wiki)
+            else:
+                page = WikiPage(name, self.wiki, sha=self.commit_id.decode())
+                page._commit_id = self.commit_id
+            self._pages[name] = page
+        return page
+
+    def partials(self, imports):
+        """Pages imported by a page, and the pages they import.
+
+        :param imports: Names imported by the page being rendered.
+        :return: list -- (name, text) tuples, deepest imports first
+
+        """
+        return self.wiki.import_graph.resolve(imports, self)
+
+
+class WikiTransaction(HookMixin):
+    """Changes to several pages, committed at once by :meth:`save_transaction`.
+
+    Pages are read at HEAD, with the changes already made in the transaction
+    applied, and must not have changed when committing. Hooks on
+    ``save_transaction`` get the whole batch from :attr:`written` and
+    :attr:`deleted`; a rename is the old page deleted and the new one written.
+    Hooks are registered by method name, so methods have names no other hooked
+    class uses.
+
+    """
+
+    def __init__(self, wiki):
+        self.wiki = wiki
+        self.changes = {}
+        self._snapshot = wiki.snapshot()
+        # Blob sha of every page read from the snapshot, None if it didn't exist
+        self._read = {}
+
+    def _snapshot_page(self, name):
+        page = self._snapshot.get_page(name)
+        exists = bool(page)
+        self._read[page.filename] = page.blob_sha if exists else None
+        return page if exists else None
+
+    def _content(self, name):
+        filename = cname_to_filename(name)
+        if filename in self.changes:
+            content = self.changes[filename]
+        else:
+            page = self._snapshot_page(name)
+            content = page.data if page else None
+        if content is None:
+            raise PageNotFound(name)
+        return content
+
+    def write_page(self, name, content):
+        """Set the content of a page.
+
+        :param name: Name of page.
+        :param content: Content of page.
+
+        """
+        self.changes[cname_to_filename(name)] = content
+
+    def rename_page(self, name, new_name):
+        """Rename a page, raises PageNotFound if it doesn't exist.
+
+        :param name: Name of page.
+        :param new_name: New name of page.
+
+        """
+        content = self._content(name)
+        if name != new_name:
+            self._remove(name)
+            self.changes[cname_to_filename(new_name)] = content
+
+    def delete_page(self, name):
+        """Delete a page, raises PageNotFound if it doesn't exist.
+
+        :param name: Name of page.
+
+        """
+        self._content(name)
+        self._remove(name)
+
+    def _remove(self, name):
+        filename = cname_to_filename(name)
+        if self._snapshot_page(name):
+            self.changes[filename] = None
+        else:
+            # Only written in this transaction
+            del self.changes[filename]
+
+    @property
+    def written(self):
+        """Pages written, as (name, text) tuples sorted by name."""
+        return sorted(
+            (
+                filename_to_cname(filename),
+                (
+                    content.decode("utf-8", "replace")
+                    if isinstance(content, bytes)
+                    else content
+                ),
             )
+            for filename, content in self.changes.items()
+            if content is not None
+        )
+
+    @property
+    def deleted(self):
+        """Names of pages deleted, sorted."""
+        return sorted(
+            filename_to_cname(filename)
+            for filename, content in self.changes.items()
+            if content is None
+        )
+
+    def save_transaction(self, message=None, username=None, email=None):
+        """Commit all changes.
+
+        Raises PageChanged if a page the transaction read changed since.
+
+        :param message: Commit message.
+        :param username: Committer name.
+        :param email: Committer email.
+        :return: bytes -- Commit sha1, None if there was nothing to commit
+
+        """
+        try:
+            head = self.wiki.resolve()
+        except KeyError:
+            # No commits yet
+            head = None
+        # Leave out what wouldn't change, for the hooks
+        entries, _ = self.wiki._changed_entries(head, self.changes)
+        self.changes = dict(
+            (filename, content)
+            for filename, content in self.changes.items()
+            if filename.encode("utf-8") in entries
+        )
+        if not self.changes:
+            return None
 
-        return rv
+        if not message:
+            message = "Updated {0} pages".format(len(self.changes))
+
+        if not username:
+            username = self.wiki.default_committer_name
+        if not email:
+            email = self.wiki.default_committer_email
+
+        return self.wiki.commit(
+            name=username,
+            email=email,
+            message=message,
+            changes=dict(self.changes),
+            expected=dict(self._read),
+        )
 
 
 class WikiPage(HookMixin):
+    history_chunk_size = 100
+    merge_attempts = 5
+
     def __init__(self, name, wiki, sha="HEAD"):
         self.name = name
         self.filename = cname_to_filename(name)
         self.sha = sha.encode("latin-1")
         self.wiki = wiki
+        self._forget()
+
+    def _forget(self):
+        """Drop what was memoised about the page, e.g. after committing to it."""
+        self._commit_id = None
+        self._blob_sha = None
+        self._meta = None
+
+    @property
+    def commit_id(self):
+        """Commit id ``sha`` resolved to when first needed.
+
+        Cached data is keyed on it rather than on a moving ref, so a commit from
+        any process makes the old entries unreachable instead of stale.
+        """
+        if self._commit_id is None:
+            self._commit_id = self.wiki.resolve(self.sha)
+        return self._commit_id
+
+    @property
+    def blob_sha(self):
+        """Sha of the page blob in the tree of this page's commit."""
+        if self._blob_sha is None:
+            mode, self._blob_sha = self.wiki.lookup_path(
+                self.commit_id, self.filename.encode()
+            )
+        return self._blob_sha
 
     @property
     def data(self):
-        cache_key = self._cache_key("data")
-        cached = cache.get(cache_key)
-        if cached:
-            return cached
-
-        mode, sha = tree_lookup_path(
-            self.wiki.repo.get_object,
-            self.wiki.repo[self.sha].tree,
-            self.filename.encode(),
-        )
-        data = self.wiki.repo[sha].data
-        cache.set(cache_key, data)
-        return data
+        return self.wiki.get_blob(self.blob_sha)
 
     @property
     def history(self):
@@ -119,81 +708,182 @@ class WikiPage(HookMixin):
 
         History can take a long time to generate for repositories with many commits.
         This returns an iterator to avoid having to load them all at once, and caches
-        as it goes.
+        as it goes in chunks of ``history_chunk_size`` revisions, so extending the
+        cache only rewrites the chunk being filled and a small summary.
 
         :return: iter -- Iterator over dicts
 
         """
-        cache_head = []
-        cache_tail = cache.get(self._cache_key("history")) or [{"_cache_missing": True}]
-        while True:
-            if not cache_tail:
-                return
-            index = 0
-            for index, cached_rev in enumerate(cache_tail):
-                if cached_rev.get("_cache_missing"):
-                    break
-                else:
-                    cache_head.append(cached_rev)
-                    yield cached_rev
-            cache_tail = cache_tail[index + 1 :]
-
-            start_sha = cached_rev.get("sha")
-            end_sha = cache_tail[0].get("sha") if cache_tail else None
-            for rev in self._iter_revs(
-                start_sha=start_sha,
-                end_sha=end_sha,
-                filename=cached_rev.get("filename"),
-            ):
-                cache_head.append(rev)
-                placeholder = {
-                    "_cache_missing": True,
-                    "sha": rev["sha"],
-                    "filename": rev["new_filename"],
-                }
-                cache.set(
-                    self._cache_key("history"), cache_head + [placeholder] + cache_tail
-                )
-                yield rev
-            cache.set(self._cache_key("history"), cache_head + cache_tail)
+        return self.iter_history()
 
-    def _iter_revs(self, start_sha=None, end_sha=None, filename=None):
-        if end_sha:
-            end_sha = [end_sha]
-        if not len(self.wiki.repo.open_index()):
-            # Index is empty, no commits
+    def iter_history(self, start=0):
+        """Iterate over page history from position ``start``.
+
+        Only cached chunks from the one holding ``start`` on are read.
+
+        :param start: Position of the first revision.
+        :return: iter -- Iterator over dicts
+
+        """
+        try:
+            summary = self._history_summary()
+        except KeyError:
+            # No commits yet
+            return iter([])
+        size = self.history_chunk_size
+        chunk_no = min(start // size, max(summary["chunks"] - 1, 0))
+        last = None
+        if chunk_no:
+            previous = cache.get(self._history_chunk_key(chunk_no - 1))
+            if previous is None:
+                chunk_no = 0
+            else:
+                last = previous[-1]
+        revs = self._iter_history(summary, chunk_no, last)
+        return itertools.islice(revs, start - chunk_no * size, None)
+
+    def _iter_history(self, summary, chunk_no, last):
+        chunk, evicted = [], False
+        while chunk_no < summary["chunks"]:
+            cached = cache.get(self._history_chunk_key(chunk_no))
+            if cached is None:
+                # Regenerate from the last revision we have
+                evicted = True
+                break
+            for rev in cached:
+                yield rev
+            last = cached[-1]
+            if len(cached) < self.history_chunk_size:
+                # Last chunk isn't full yet, keep filling it
+                chunk = list(cached)
+                break
+            chunk_no += 1
+        if summary["complete"] and not evicted:
             return
+
+        if last:
+            revs = self._iter_revs(
+                start_sha=last["sha"],
+                filename=last["old_filename"] or last["new_filename"],
+            )
+        else:
+            revs = self._iter_revs()
+        complete = False
+        try:
+            for rev in revs:
+                chunk.append(rev)
+                yield rev
+                if len(chunk) == self.history_chunk_size:
+                    self._store_history_chunk(chunk_no, chunk, False)
+                    chunk_no, chunk = chunk_no + 1, []
+            complete = True
+        finally:
+            self._store_history_chunk(chunk_no, chunk, complete)
+
+    def history_page(self, start=0, length=10, cursor=None):
+        """Get a page of history.
+
+        :param start: Position of the first revision.
+        :param length: Number of revisions.
+        :param cursor: Cursor returned for a previous page, resumes right after it
+            without going through the revisions before.
+        :return: tuple -- (list of dicts, cursor of the next page or None)
+
+        """
+        if cursor:
+            sha, filename, start = decode_cursor(cursor, (text_type, text_type, int))
+            if not re.match(r"^[0-9a-f]{40}$", sha):
+                raise ValueError("Invalid cursor")
+            revs = self._iter_revs(start_sha=sha, filename=filename)
+        else:
+            revs = self.iter_history(start)
+        items = list(itertools.islice(revs, length))
+        if len(items) < length:
+            return items, None
+        last = items[-1]
+        return items, encode_cursor(
+            last["sha"], last["old_filename"] or last["new_filename"], start + length
+        )
+
+    @property
+    def history_count(self):
+        """Exact number of revisions, None when it can't be counted cheaply."""
+        try:
+            start = self.commit_id.decode()
+        except KeyError:
+            return 0
+        history_index = self.wiki.history_index
+        history_index.update(self.wiki.repo)
+        if not history_index.covers(start):
+            return None
+        return history_index.count_revs(self.filename, start)
+
+    def _history_summary(self):
+        return cache.get(self._cache_key("history")) or dict(
+            chunks=0, count=0, complete=False
+        )
+
+    def _history_chunk_key(self, chunk_no):
+        return self._cache_key("history.{0}".format(chunk_no))
+
+    def _store_history_chunk(self, chunk_no, chunk, complete):
+        """Store a chunk being filled and the summary of all chunks before it."""
+        count = chunk_no * self.history_chunk_size + len(chunk)
+        if chunk:
+            cache.set(self._history_chunk_key(chunk_no), chunk)
+            chunk_no += 1
+        cache.set(
+            self._cache_key("history"),
+            dict(chunks=chunk_no, count=count, complete=complete),
+        )
+
+    def _iter_revs(self, start_sha=None, filename=None):
         filename = filename or self.filename
-        filename = filename.encode("utf-8")
+        start = start_sha or self.commit_id.decode()
+        history_index = self.wiki.history_index
+        history_index.update(self.wiki.repo)
+        if history_index.covers(start):
+            return history_index.iter_revs(filename, start, skip_start=bool(start_sha))
+        # Commits off the indexed line of history, or after a merge, are walked
+        return self._walk_revs(start, filename, bool(start_sha))
+
+    def _walk_revs(self, start, filename, skip_start):
         walker = iter(
             self.wiki.repo.get_walker(
-                paths=[filename], include=start_sha, exclude=end_sha, follow=True
+                paths=[filename.encode("utf-8")], include=[start.encode()], follow=True
             )
         )
-        if start_sha:
+        if skip_start:
             # If we are not starting from HEAD, we already have the start commit
-            next(walker)
-        filename = self.filename
+            next(walker, None)
+        filename = filename.encode("utf-8")
         for entry in walker:
-            change_type = None
+            change = None
             for change in entry.changes():
                 if change.new.path == filename:
                     filename = change.old.path
-                    change_type = change.type
                     break
 
-            author_name, author_email = entry.commit.author.rstrip(b">").split(b"<")
-            r = dict(
-                author=author_name.strip(),
-                author_email=author_email,
-                time=entry.commit.author_time,
-                message=entry.commit.message,
-                sha=entry.commit.id,
-                type=change_type,
-                new_filename=change.new.path,
-                old_filename=change.old.path,
-            )
-            yield r
+            yield make_rev(entry.commit, change)
+
+    @property
+    def last_rev(self):
+        """Latest revision of the page.
+
+        Read from the history index when the page is at the indexed head, without
+        walking history.
+
+        :return: dict -- None if the page has no history
+
+        """
+        history_index = self.wiki.history_index
+        history_index.update(self.wiki.repo)
+        head = self.commit_id.decode()
+        if history_index.head == head and history_index.covers(head):
+            revs = history_index.path_revs(self.filename).get(self.filename)
+            if revs:
+                return dict(revs["last"], new_filename=self.filename)
+        return next(self.history, None)
 
     @property
     def history_cache(self):
@@ -201,42 +891,30 @@ class WikiPage(HookMixin):
 
         :return: tuple -- (cached items, cache complete?)
         """
-        cached_revs = cache.get(self._cache_key("history"))
-        if not cached_revs:
+        try:
+            summary = self._history_summary()
+        except KeyError:
             return 0, False
-        elif any(rev.get("_cache_missing") for rev in cached_revs):
-            return len(cached_revs) - 1, False
-        return len(cached_revs), True
+        return summary["count"], summary["complete"]
 
     @property
-    def imports(self):
-        """Names"""
-        meta = self._get_meta(self.data) or {}
-        return meta.get("import", [])
-
-    @staticmethod
-    def _get_meta(content):
-        """Get metadata from page if any.
+    def meta(self):
+        """Front matter of the page, parsed once per blob.
 
-        :param content: Page content
         :return: dict
 
         """
-        if not content.startswith(b"---"):
-            return None
-
-        meta_end = re.search("\n(\.{3}|\-{3})", content)
+        if self._meta is None:
+            self._meta = self.wiki.get_meta(self.blob_sha) or {}
+        return self._meta
 
-        if not meta_end:
-            return None
-
-        try:
-            return yaml.safe_load(content[0 : meta_end.start()])
-        except Exception as e:
-            return {"error": e.message}
+    @property
+    def imports(self):
+        """Names"""
+        return self.meta.get("import", [])
 
     def _cache_key(self, property):
-        return "page/{0}[{1}].{2}".format(self.name, self.sha, property)
+        return "page/{0}[{1}].{2}".format(self.name, self.commit_id.decode(), property)
 
     def _get_user(self, username, email):
         if not username:
@@ -247,15 +925,6 @@ class WikiPage(HookMixin):
 
         return username, email
 
-    def _invalidate_cache(self, save_history=None):
-        cache.delete(self._cache_key("data"))
-        if save_history:
-            if not save_history[0].get("_cache_missing"):
-                save_history = [{"_cache_missing": True}] + save_history
-            cache.set(self._cache_key("history"), save_history)
-        else:
-            cache.delete(self._cache_key("history"))
-
     def delete(self, username=None, email=None, message=None):
         """Delete page.
         :param username: Committer name
@@ -268,25 +937,28 @@ class WikiPage(HookMixin):
         if not message:
             message = "Deleted %s" % self.name
 
-        os.remove(os.path.join(self.wiki.path, self.filename))
         commit = self.wiki.commit(
-            name=username, email=email, message=message, files=[self.filename]
+            name=username, email=email, message=message, changes={self.filename: None}
         )
-        self._invalidate_cache()
+        self._forget()
         return commit
 
     def rename(self, new_name, username=None, email=None, message=None):
         """Rename page.
 
+        The content moved is the page's at HEAD when committing, so edits landing
+        meanwhile move with it; raises PageConflict if the page is deleted or keeps
+        changing.
+
         :param new_name: New name of page.
         :param username: Committer name
         :param email: Committer email
         :return: str -- Commit sha1
 
         """
-        assert self.sha == "HEAD"
+        assert self.sha == b"HEAD"
         old_filename, new_filename = self.filename, cname_to_filename(new_name)
-        if old_filename not in self.wiki.repo.open_index():
+        if old_filename not in self.wiki.index:
             # old doesn't exist
             return None
         elif old_filename == new_filename:
@@ -300,56 +972,121 @@ class WikiPage(HookMixin):
         if not message:
             message = "Moved {0} to {1}".format(self.name, new_name)
 
-        os.rename(
-            os.path.join(self.wiki.path, old_filename),
-            os.path.join(self.wiki.path, new_filename),
-        )
-        commit = self.wiki.commit(
-            name=username,
-            email=email,
-            message=message,
-            files=[old_filename, new_filename],
-        )
+        for _ in range(self.merge_attempts):
+            try:
+                head = self.wiki.resolve()
+            except KeyError:
+                # No commits yet
+                head = None
+            blob_sha = self.wiki._blob_sha_at(head, old_filename)
+            if blob_sha is None:
+                raise PageConflict("%s was deleted" % self.name)
+            try:
+                commit = self.wiki.commit(
+                    name=username,
+                    email=email,
+                    message=message,
+                    changes={
+                        old_filename: None,
+                        new_filename: self.wiki.get_blob(blob_sha),
+                    },
+                    expected={old_filename: blob_sha},
+                )
+            except PageChanged:
+                # Written again since we read it
+                continue
+            break
+        else:
+            raise PageConflict("%s keeps changing" % self.name)
 
-        old_history = cache.get(self._cache_key("history"))
-        self._invalidate_cache()
         self.name = new_name
         self.filename = new_filename
-        # We need to clear the cache for the new name as well as the old
-        self._invalidate_cache(save_history=old_history)
+        self._forget()
 
         return commit
 
-    def write(self, content, message=None, username=None, email=None):
+    def write(
+        self,
+        content,
+        message=None,
+        username=None,
+        email=None,
+        base_sha=None,
+        base_name=None,
+    ):
         """Write page to git repo
 
         :param content: Content of page.
         :param message: Commit message.
         :param username: Commit Name.
         :param email: Commit Email.
-        :return: Git commit sha1.
+        :param base_sha: Commit the content was edited from. If the page changed
+            since, both changes are merged; raises PageConflict if they overlap.
+        :param base_name: Name of the page in the base commit, if it was renamed.
+        :return: Git commit sha1, None if the content didn't change.
         """
         assert self.sha == b"HEAD"
-        dirname = posixpath.join(self.wiki.path, posixpath.dirname(self.filename))
-
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-
-        with open(self.wiki.path + "/" + self.filename, "w") as f:
-            f.write(content)
 
         if not message:
             message = "Updated %s" % self.name
 
         username, email = self._get_user(username, email)
 
-        ret = self.wiki.commit(
-            name=username, email=email, message=message, files=[self.filename]
-        )
+        if not base_sha:
+            ret = self.wiki.commit(
+                name=username,
+                email=email,
+                message=message,
+                changes={self.filename: content},
+            )
+            self._forget()
+            return ret
 
-        old_history = cache.get(self._cache_key("history"))
-        self._invalidate_cache(save_history=old_history)
-        return ret
+        if isinstance(content, text_type):
+            content = content.encode("utf-8")
+        try:
+            base_blob = self.wiki._blob_sha_at(
+                self.wiki.resolve(base_sha),
+                cname_to_filename(base_name) if base_name else self.filename,
+            )
+        except KeyError:
+            raise PageConflict("Unknown base commit %s" % base_sha)
+
+        for _ in range(self.merge_attempts):
+            try:
+                head = self.wiki.resolve()
+            except KeyError:
+                # No commits yet
+                head = None
+            head_blob = self.wiki._blob_sha_at(head, self.filename)
+            try:
+                ret = self.wiki.commit(
+                    name=username,
+                    email=email,
+                    message=message,
+                    changes={self.filename: self._merge(content, base_blob, head_blob)},
+                    expected={self.filename: head_blob},
+                )
+            except PageChanged:
+                # Written again while we merged
+                continue
+            self._forget()
+            return ret
+        raise PageConflict("%s keeps changing" % self.name)
+
+    def _merge(self, content, base_blob, head_blob):
+        if head_blob == base_blob:
+            return content
+        if head_blob is None:
+            raise PageConflict("%s was deleted" % self.name)
+        base = self.wiki.get_blob(base_blob) if base_blob else b""
+        merged, conflicts = merge3(base, content, self.wiki.get_blob(head_blob))
+        if merged is None:
+            raise PageConflict(
+                "%s was changed, %d change(s) conflict with yours"
+                % (self.name, conflicts)
+            )
+        return merged
 
     def revert(self, commit_sha, message, username, email):
         """Revert page to passed commit sha1
@@ -358,10 +1095,10 @@ class WikiPage(HookMixin):
         :param message: Commit message.
         :param username: Committer name.
         :param email: Committer email.
-        :return: Git commit sha1
+        :return: Git commit sha1, None if the content didn't change
 
         """
-        assert self.sha == "HEAD"
+        assert self.sha == b"HEAD"
         new_page = self.wiki.get_page(self.name, commit_sha)
         if not new_page:
             raise PageNotFound("Commit not found")
@@ -386,10 +1123,10 @@ class WikiPage(HookMixin):
     def __nonzero__(self):
         # Verify this file is in the tree for the given commit sha
         try:
-            tree_lookup_path(
-                self.wiki.repo.get_object, self.wiki.repo[self.sha].tree, self.filename
-            )
+            self.blob_sha
         except KeyError:
             # We'll get a KeyError if self.sha isn't in the repo, or if self.filename isn't in the tree of our commit
             return False
         return True
+
+    __bool__ = __nonzero__
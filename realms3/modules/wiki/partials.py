@@ -0,0 +1,93 @@
+import collections
+
+from six import string_types
+
+from .caches import LRUCache
+
+
+def _names(imports):
+    """Page names from an ``import`` front matter value, a name or list of names."""
+    if isinstance(imports, string_types):
+        imports = [imports]
+    elif not isinstance(imports, (list, tuple)):
+        return []
+    return [name for name in imports if isinstance(name, string_types)]
+
+
+class ImportGraph(object):
+    """Import edges between pages and the partial bundles resolved from them.
+
+    What a page imports only depends on its content, so forward edges come from
+    front matter cached by blob sha. A bundle records the blob sha of every page it
+    was built from, so it is reused at any commit where those are unchanged and
+    rebuilt at the first one where they aren't, whichever process wrote them.
+
+    :param max_depth: How many levels of imports are followed.
+    :param max_pages: Most pages a bundle can hold, imports beyond are ignored.
+
+    """
+
+    def __init__(self, max_depth=5, max_pages=50, max_bundles=10000):
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self._bundles = LRUCache(max_bundles, sizeof=lambda bundle: 1)
+
+    def imports_of(self, page):
+        """Names imported by a page.
+
+        Front matter is cached per blob sha by the wiki, so these are the forward
+        edges of the graph.
+
+        :param page: WikiPage that exists.
+        :return: list
+
+        """
+        return _names(page.imports)
+
+    def resolve(self, imports, snapshot):
+        """Resolve imports to partials, breadth first.
+
+        :param imports: Names imported by the page being rendered, as in its
+            front matter.
+        :param snapshot: WikiSnapshot to read pages from.
+        :return: list -- (name, text) tuples, deepest imports first
+
+        """
+        key = tuple(_names(imports))
+        bundle = self._bundles.get(key)
+        if bundle is not None and self._is_current(bundle, snapshot):
+            return bundle[1]
+
+        queue = collections.deque((name, 1) for name in key)
+        partials = collections.OrderedDict()
+        deps = []
+        while queue and len(partials) < self.max_pages:
+            name, depth = queue.popleft()
+            if name in partials:
+                continue
+            page = snapshot.get_page(name)
+            try:
+                blob_sha = page.blob_sha
+            except KeyError:
+                partials[name] = "`Error importing wiki page '{0}'`".format(name)
+                deps.append((name, None))
+                continue
+            deps.append((name, blob_sha))
+            partials[name] = page.data.decode("utf-8", "replace")
+            if depth < self.max_depth:
+                queue.extend((child, depth + 1) for child in self.imports_of(page))
+
+        # We want to retain the order (and reverse it) so that combining metadata from the imports works
+        result = list(reversed(list(partials.items())))
+        self._bundles.set(key, (tuple(deps), result))
+        return result
+
+    def _is_current(self, bundle, snapshot):
+        for name, blob_sha in bundle[0]:
+            try:
+                current = snapshot.get_page(name).blob_sha
+            except KeyError:
+                current = None
+            if current != blob_sha:
+                return False
+        return True
@@ -1,10 +1,24 @@
 import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+from unittest import TestCase
 
+from dulwich.object_store import MemoryObjectStore
+from dulwich.objects import Blob, Commit
 from nose.tools import *
 from flask import url_for
 
+from realms3 import cache
 from realms3.lib.util import cname_to_filename, filename_to_cname
 from realms3.lib.test import BaseTest
+from realms3.modules.wiki.caches import LRUCache
+from realms3.modules.wiki.index import DirectoryNode, paginate
+from realms3.modules.wiki.merge import merge3
+from realms3.modules.wiki.models import PageChanged, PageConflict, Wiki
+from realms3.modules.wiki.writes import WriteCoordinator, update_tree
 
 
 class WikiBaseTest(BaseTest):
@@ -33,6 +47,133 @@ class UtilTest(WikiBaseTest):
         eq_(filename_to_cname("test-1-2-3.md"), "test-1-2-3")
 
 
+class LRUCacheTest(TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(max_size=6)
+        lru.set("a", b"aa")
+        lru.set("b", b"bb")
+        lru.get("a")
+        lru.set("c", b"cccc")
+        eq_(lru.get("b"), None)
+        eq_(lru.get("a"), b"aa")
+        eq_(lru.get("c"), b"cccc")
+        eq_(lru.size, 6)
+
+    def test_skips_oversized_values(self):
+        lru = LRUCache(max_size=2)
+        lru.set("a", b"aaa")
+        eq_(len(lru), 0)
+
+
+class PaginateTest(TestCase):
+    def rows(self, names):
+        return [
+            dict(name=name, size=i, ctime=i, mtime=i) for i, name in enumerate(names)
+        ]
+
+    def test_cursor(self):
+        rows = self.rows("abcde")
+        items, total, cursor = paginate(rows, length=2)
+        eq_([row["name"] for row in items], ["a", "b"])
+        eq_(total, 5)
+
+        # Resumes after the last name even if rows were added before it
+        rows.insert(0, dict(name="0", size=0, ctime=0, mtime=0))
+        items, total, cursor = paginate(rows, length=2, cursor=cursor)
+        eq_([row["name"] for row in items], ["c", "d"])
+        items, total, cursor = paginate(rows, length=2, cursor=cursor)
+        eq_([row["name"] for row in items], ["e"])
+        eq_(cursor, None)
+
+    def test_reverse(self):
+        rows = self.rows("abcde")
+        items, _, cursor = paginate(rows, reverse=True, length=2)
+        eq_([row["name"] for row in items], ["e", "d"])
+        items, _, cursor = paginate(rows, reverse=True, length=2, cursor=cursor)
+        eq_([row["name"] for row in items], ["c", "b"])
+        items, _, _ = paginate(rows, sort="size", reverse=True, length=2)
+        eq_([row["name"] for row in items], ["e", "d"])
+
+    def test_invalid(self):
+        assert_raises(ValueError, paginate, self.rows("ab"), sort="bogus")
+        assert_raises(ValueError, paginate, self.rows("ab"), cursor="garbage")
+
+
+class DirectoryNodeTest(TestCase):
+    def setUp(self):
+        self.tree = DirectoryNode()
+        for name, size, ctime, mtime in [
+            ("a", 1, 5, 6),
+            ("docs/b", 2, 3, 8),
+            ("docs/api/c", 4, 1, 2),
+        ]:
+            entry = dict(name=name, size=size, ctime=ctime, mtime=mtime)
+            self.tree.add(entry, name.split("/"))
+
+    def test_rollups(self):
+        docs = self.tree.lookup("docs")
+        eq_((docs.size, docs.count, docs.ctime, docs.mtime), (6, 2, 1, 8))
+        eq_((self.tree.size, self.tree.count), (7, 3))
+        eq_(
+            [(item["name"], item["dir"]) for item in docs.listing()],
+            [("docs/api/", True), ("docs/b", False)],
+        )
+
+    def test_lookup(self):
+        ok_(self.tree.lookup("") is self.tree)
+        eq_(self.tree.lookup("/docs/api/").name, "docs/api/")
+        eq_(self.tree.lookup("docs/b"), None)
+        eq_(self.tree.lookup("missing"), None)
+
+
+class WriteCoordinatorTest(TestCase):
+    def test_submit(self):
+        batches = []
+        with tempfile.NamedTemporaryFile() as lock_file:
+            writes = WriteCoordinator(
+                lock_file.name, after_batch=lambda: batches.append(1)
+            )
+            eq_(writes.submit(lambda: "sha"), "sha")
+            assert_raises(ValueError, writes.submit, lambda: int("x"))
+        eq_(len(batches), 2)
+
+
+class UpdateTreeTest(TestCase):
+    def paths(self, store, tree_id):
+        return sorted(entry.path for entry in store.iter_tree_contents(tree_id))
+
+    def test_update_tree(self):
+        store = MemoryObjectStore()
+        a, b = Blob.from_string(b"a"), Blob.from_string(b"b")
+        store.add_objects([(a, None), (b, None)])
+
+        tree_id = update_tree(
+            store, None, {b"a.md": (0o100644, a.id), b"d/e/b.md": (0o100644, b.id)}
+        )
+        eq_(self.paths(store, tree_id), [b"a.md", b"d/e/b.md"])
+
+        tree_id = update_tree(store, tree_id, {b"d/e/b.md": (0o100644, a.id)})
+        eq_(store[tree_id].lookup_path(store.__getitem__, b"d/e/b.md")[1], a.id)
+
+        # Emptied directories go away
+        tree_id = update_tree(store, tree_id, {b"d/e/b.md": None})
+        eq_(self.paths(store, tree_id), [b"a.md"])
+        eq_(update_tree(store, tree_id, {b"a.md": None}), None)
+
+
+class Merge3Test(TestCase):
+    base = "a\nb\nc\nd\n"
+
+    def test_merges_separate_changes(self):
+        eq_(merge3(self.base, "A\nb\nc\nd\n", "a\nb\nc\nD\n"), ("A\nb\nc\nD\n", 0))
+
+    def test_conflicting_changes(self):
+        eq_(merge3(self.base, "A\nb\nc\nd\n", "X\nb\nc\nd\n"), (None, 1))
+
+    def test_same_change(self):
+        eq_(merge3(self.base, "A\nb\nc\nd\n", "A\nb\nc\nd\n"), ("A\nb\nc\nd\n", 0))
+
+
 class WikiTest(WikiBaseTest):
     def test_routes(self):
         self.assert_200(self.client.get(url_for("wiki.create")))
@@ -54,11 +195,388 @@ class WikiTest(WikiBaseTest):
 
         self.assert_context("name", "test")
         eq_(next(self.get_context_variable("page").history)["message"], "test message")
+        eq_(self.get_context_variable("page").last_rev["message"], "test message")
         eq_(self.get_context_variable("page").data, "testing")
 
+    def test_partials(self):
+        self.create_page("a", content="---\nimport: [b]\n---\nA")
+        self.create_page("b", content="---\nimport: [a]\n---\nB")
+
+        rv = self.client.get(url_for("wiki.partials"), query_string={"imports[]": "a"})
+        eq_([name for name, _ in rv.json["partials"]], ["b", "a"])
+
+        self.update_page("b", content="---\nimport: [a]\n---\nB2")
+        rv = self.client.get(url_for("wiki.partials"), query_string={"imports[]": "a"})
+        eq_(rv.json["partials"][0][1], "---\nimport: [a]\n---\nB2")
+
+        self.create_page("c", content="---\nimport: b\n---\nC")
+        self.create_page("d", content="---\nimport:\n---\nD")
+        self.assert_200(self.client.get(url_for("wiki.page", name="c")))
+        self.assert_200(self.client.get(url_for("wiki.page", name="d")))
+        snapshot = self.app.extensions["wiki"].snapshot()
+        eq_(
+            [name for name, _ in snapshot.partials(snapshot.get_page("c").imports)],
+            ["a", "b"],
+        )
+        eq_(snapshot.partials(snapshot.get_page("d").imports), [])
+
+    def test_find_pages(self):
+        self.create_page("a", content="---\ntags: [x, y]\n---\nA")
+        self.create_page("b", content="---\ntags: y\n---\nB")
+
+        rv = self.client.get(url_for("wiki.find_pages", key="tags", value="y"))
+        eq_(rv.json["pages"], ["a", "b"])
+
+        self.update_page("a", content="A")
+        rv = self.client.get(url_for("wiki.find_pages", key="tags"))
+        eq_(rv.json["pages"], ["b"])
+
+    def test_transaction(self):
+        self.create_page("a", message="test message", content="A")
+        self.create_page("b", message="test message", content="B")
+        rv = self.client.post(
+            url_for("wiki.transaction"),
+            data=json.dumps(
+                dict(
+                    message="reorganise",
+                    changes=[
+                        dict(action="write", name="c", content="C"),
+                        dict(action="rename", name="a", new_name="section/a"),
+                        dict(action="delete", name="b"),
+                    ],
+                )
+            ),
+            content_type="application/json",
+            headers={"X-CSRFToken": self.client.csrf_token},
+        )
+        self.assert_200(rv)
+        eq_(
+            [entry["name"] for entry in self.app.extensions["wiki"].get_index()],
+            ["c", "section/a"],
+        )
+        eq_(self.app.extensions["wiki"].get_page("c").last_rev["message"], "reorganise")
+
+    def test_transaction_concurrent_edit(self):
+        wiki = self.app.extensions["wiki"]
+        wiki.get_page("a").write("A")
+        wiki.get_page("b").write("B")
+        txn = wiki.transaction()
+        txn.rename_page("a", "c")
+        txn.write_page("d", "D")
+        eq_(txn.written, [("c", "A"), ("d", "D")])
+
+        wiki.get_page("a").write("concurrent edit")
+        assert_raises(PageChanged, txn.save_transaction)
+        eq_(wiki.get_page("a").data, b"concurrent edit")
+        ok_(not wiki.get_page("c"))
+
+        # Pages only written don't have to be as they were
+        txn = wiki.transaction()
+        txn.delete_page("b")
+        txn.write_page("a", "A2")
+        wiki.get_page("a").write("concurrent edit 2")
+        ok_(txn.save_transaction())
+        eq_(wiki.get_page("a").data, b"A2")
+
+    def test_write_unchanged(self):
+        rv = self.create_page("test", message="test message", content="testing")
+        rv2 = self.update_page("test", message="again", content="testing")
+        eq_(rv2.json["sha"], rv.json["sha"])
+
+    def test_write_merges(self):
+        base = self.create_page("test", content="a\nb\nc\nd\n").json["sha"]
+        self.update_page("test", content="A\nb\nc\nd\n")
+
+        rv = self.client.post(
+            url_for("wiki.page_write", name="test"),
+            data=dict(
+                message="merge",
+                content="a\nb\nc\nD\n",
+                sha=base,
+                csrf_token=self.client.csrf_token,
+            ),
+        )
+        self.assert_200(rv)
+        eq_(self.app.extensions["wiki"].get_page("test").data, b"A\nb\nc\nD\n")
+
+        rv = self.client.post(
+            url_for("wiki.page_write", name="test"),
+            data=dict(
+                message="conflict",
+                content="X\nb\nc\nd\n",
+                sha=base,
+                csrf_token=self.client.csrf_token,
+            ),
+        )
+        self.assert_status(rv, 409)
+
+    def test_write_renamed_base(self):
+        wiki = self.app.extensions["wiki"]
+        base = wiki.get_page("a").write("a\nb\nc\nd\n").decode()
+        wiki.get_page("a").write("A\nb\nc\nd\n")
+        wiki.get_page("a").rename("b")
+        wiki.get_page("b").write("a\nb\nc\nD\n", base_sha=base, base_name="a")
+        eq_(wiki.get_page("b").data, b"A\nb\nc\nD\n")
+
+        assert_raises(KeyError, wiki.resolve, "\xe9")
+        assert_raises(PageConflict, wiki.get_page("b").write, "x", base_sha="\xe9" * 20)
+
+    def test_maintenance(self):
+        self.create_page("test", message="test message", content="testing_old")
+        self.update_page("test", message="test message", content="testing_new")
+        wiki = self.app.extensions["wiki"]
+
+        report = wiki.maintenance.run(force=True)
+        eq_(report["action"], "repack")
+        eq_(report["after"]["pack_count"], 1)
+        # Loose copies are only removed by the next run
+        ok_(report["after"]["loose_count"] > 0)
+
+        report = wiki.maintenance.run()
+        eq_(report["action"], None)
+        eq_(report["after"]["loose_count"], 0)
+        eq_(wiki.get_page("test").data, b"testing_new")
+
+    def test_maintenance_namespaced(self):
+        self.create_page("a/b", message="test message", content="testing_old")
+        self.update_page("a/b", message="test message", content="testing_new")
+        wiki = self.app.extensions["wiki"]
+
+        eq_(wiki.maintenance.run(force=True)["action"], "repack")
+        report = wiki.maintenance.run(force=True)
+        eq_(report["after"]["pack_count"], 1)
+        eq_(report["after"]["loose_count"], 0)
+        eq_(wiki.get_page("a/b").data, b"testing_new")
+
+    def test_maintenance_during_writes(self):
+        wiki = self.app.extensions["wiki"]
+        wiki.get_page("test").write("testing")
+        reports = []
+        maintain = threading.Thread(
+            target=lambda: reports.append(wiki.maintenance.run(force=True))
+        )
+        # Writes aren't held off
+        with wiki.writes.locked():
+            maintain.start()
+            maintain.join(10)
+        eq_([report["action"] for report in reports], ["repack"])
+        eq_(wiki.get_page("test").data, b"testing")
+
     def test_history(self):
         self.assert_200(self.client.get(url_for("wiki.history", name="test")))
 
+    def test_bare_repo(self):
+        wiki = Wiki(os.path.join(tempfile.mkdtemp(), "wiki.git"), checkout=False)
+        ok_(wiki.repo.bare)
+
+        wiki.get_page("a/b").write("testing", username="test", email="test@example.com")
+        eq_(wiki.get_page("a/b").data, b"testing")
+        eq_([entry["name"] for entry in wiki.index], ["a/b"])
+
+        wiki.get_page("a/b").delete(username="test", email="test@example.com")
+        ok_(not wiki.get_page("a/b"))
+        eq_(len(wiki.index), 0)
+
+    def test_index_snapshot(self):
+        wiki = self.app.extensions["wiki"]
+        wiki.get_page("a").write("A")
+        snapshot = wiki.index
+        ok_(wiki.index is snapshot)
+
+        wiki.get_page("b").write("B")
+        ok_(wiki.index is not snapshot)
+        eq_([entry["name"] for entry in wiki.index], ["a", "b"])
+        eq_([entry["name"] for entry in snapshot], ["a"])
+
+    def test_lookup_path(self):
+        wiki = self.app.extensions["wiki"]
+        wiki.get_page("docs/a").write("A")
+        commit_id = wiki.repo.head()
+        mode, sha = wiki.lookup_path(commit_id, b"docs/a.md")
+        eq_(wiki.repo[sha].data, b"A")
+        for path in (b"missing.md", b"docs/a.md/x"):
+            assert_raises(KeyError, wiki.lookup_path, commit_id, path)
+            eq_(wiki.path_cache.get((commit_id, path)), (None, None))
+
+        # Memoised, hits and misses alike, without reading the repository
+        class NoRepo(object):
+            def __getitem__(self, sha):
+                raise AssertionError("Repository read")
+
+        repo, wiki._local.repo = wiki.repo, NoRepo()
+        try:
+            eq_(wiki.lookup_path(commit_id, b"docs/a.md"), (mode, sha))
+            assert_raises(KeyError, wiki.lookup_path, commit_id, b"missing.md")
+        finally:
+            wiki._local.repo = repo
+
+    def test_snapshot_pinned(self):
+        wiki = self.app.extensions["wiki"]
+        wiki.get_page("a").write("one")
+        snapshot = wiki.snapshot()
+        page = snapshot.get_page("a")
+
+        wiki.get_page("a").write("two")
+        wiki.get_page("b").write("new")
+        ok_(snapshot.get_page("a") is page)
+        eq_(page.data, b"one")
+        ok_(not snapshot.get_page("b"))
+        eq_(wiki.snapshot().get_page("a").data, b"two")
+
+    def test_rename_concurrent_edit(self):
+        wiki = self.app.extensions["wiki"]
+        wiki.get_page("a").write("original")
+        page = wiki.get_page("a")
+        eq_(page.data, b"original")
+
+        wiki.get_page("a").write("concurrent edit")
+        page.rename("b")
+        eq_(wiki.get_page("b").data, b"concurrent edit")
+        ok_(not wiki.get_page("a"))
+
+    def test_write_bookkeeping_fails(self):
+        wiki = self.app.extensions["wiki"]
+        wiki.get_page("a").write("one")
+
+        def fail(*args):
+            raise sqlite3.OperationalError("database is locked")
+
+        wiki.history_index.update = fail
+        wiki._checkout = fail
+        sha = wiki.get_page("a").write("two")
+        eq_(wiki.resolve(), sha)
+        eq_(wiki.get_page("a").data, b"two")
+
+        del wiki.history_index.update, wiki._checkout
+        wiki.get_page("b").write("b")
+        eq_([entry["name"] for entry in wiki.index], ["a", "b"])
+        eq_(wiki.index.get("a.md")["sha"], wiki.get_page("a").blob_sha)
+        eq_(wiki.get_page("a").last_rev["sha"], sha.decode())
+
+    def commit(self, message, changes):
+        return self.app.extensions["wiki"].commit(
+            "test", "test@example.com", message, changes
+        )
+
+    def test_history_index_rename(self):
+        self.commit("one", {"a.md": "one"})
+        self.commit("two", {"a.md": "two"})
+        self.commit("move", {"a.md": None, "b.md": "two"})
+        self.commit("three", {"b.md": "three"})
+        history_index = self.app.extensions["wiki"].history_index
+        head = self.app.extensions["wiki"].resolve().decode()
+        history_index.update(self.app.extensions["wiki"].repo)
+
+        revs = list(history_index.iter_revs("b.md", head))
+        eq_([rev["message"] for rev in revs], ["three", "move", "two", "one"])
+        eq_(revs[1]["old_filename"], "a.md")
+        eq_(history_index.count_revs("b.md", head), 4)
+        revs = history_index.iter_revs("b.md", head, skip_start=True)
+        eq_([rev["message"] for rev in revs], ["move", "two", "one"])
+
+    def test_history_index_reset(self):
+        wiki = self.app.extensions["wiki"]
+        self.commit("one", {"a.md": "one"})
+        two = self.commit("two", {"a.md": "two"})
+        self.commit("three", {"a.md": "three"})
+        eq_(wiki.get_page("a").history_count, 3)
+
+        wiki.repo.refs[b"HEAD"] = two
+        eq_(wiki.get_page("a").history_count, 2)
+        self.commit("other", {"b.md": "b"})
+        page = wiki.get_page("a")
+        eq_([rev["message"] for rev in page.history], ["two", "one"])
+        eq_(page.last_rev["message"], "two")
+
+    def test_history_index_merge(self):
+        wiki = self.app.extensions["wiki"]
+        one = self.commit("one", {"a.md": "one"})
+        # Pushed straight to the repository: "side" branches off "one" and is
+        # merged after "two", but is older
+        store = wiki.repo.object_store
+
+        def add_commit(message, parents, path, offset):
+            blob = Blob.from_string(message)
+            store.add_object(blob)
+            commit = Commit()
+            commit.tree = update_tree(
+                store, wiki.repo[parents[0]].tree, {path: (0o100644, blob.id)}
+            )
+            commit.parents = parents
+            commit.author = commit.committer = b"test <test@example.com>"
+            commit.author_time = commit.commit_time = (
+                wiki.repo[one].commit_time + offset
+            )
+            commit.author_timezone = commit.commit_timezone = 0
+            commit.message = message
+            store.add_object(commit)
+            return commit.id
+
+        side = add_commit(b"side", [one], b"a.md", 1)
+        two = add_commit(b"two", [one], b"b.md", 2)
+        merge = add_commit(b"merge", [two, side], b"a.md", 3)
+        wiki.repo.refs[b"HEAD"] = merge
+        self.commit("three", {"b.md": "three"})
+
+        messages = [rev["message"] for rev in wiki.get_page("b").history]
+        eq_(messages, ["three", "two"])
+        # "side" is indexed before "two" but isn't part of its history
+        page = wiki.get_page("a", sha=two.decode())
+        eq_([rev["message"] for rev in page.history], ["one"])
+        eq_(page.history_count, None)
+
+    def history_page(self):
+        page = self.app.extensions["wiki"].get_page("test")
+        page.history_chunk_size = 2
+        return page
+
+    def test_history_chunks(self):
+        for i in range(5):
+            self.commit("rev %d" % i, {"test.md": "content %d" % i})
+        full = [rev["message"] for rev in self.history_page().history]
+        eq_(full, ["rev 4", "rev 3", "rev 2", "rev 1", "rev 0"])
+        eq_(
+            self.history_page()._history_summary(),
+            dict(chunks=3, count=5, complete=True),
+        )
+
+        # Resumes from the chunk before an evicted one
+        cache.delete(self.history_page()._history_chunk_key(1))
+        revs = self.history_page().iter_history(3)
+        eq_([rev["message"] for rev in revs], full[3:])
+        eq_([rev["message"] for rev in self.history_page().history], full)
+
+    def test_history_cursor(self):
+        for i in range(5):
+            self.commit("rev %d" % i, {"test.md": "content %d" % i})
+        page = self.app.extensions["wiki"].get_page("test")
+
+        items, cursor = page.history_page(length=2)
+        eq_([rev["message"] for rev in items], ["rev 4", "rev 3"])
+        items, cursor = page.history_page(length=2, cursor=cursor)
+        eq_([rev["message"] for rev in items], ["rev 2", "rev 1"])
+        items, cursor = page.history_page(length=2, cursor=cursor)
+        eq_([rev["message"] for rev in items], ["rev 0"])
+        eq_(cursor, None)
+        assert_raises(ValueError, page.history_page, cursor="garbage")
+
+    def test_feed_cursor(self):
+        for i in range(3):
+            self.update_page("test", message="rev %d" % i, content="content %d" % i)
+
+        rv = self.client.get(url_for("wiki.feed", name="test", length=2))
+        self.assert_200(rv)
+        data = rv.get_data(as_text=True)
+        ok_("rev 2" in data and "rev 0" not in data)
+        next_url = re.search(
+            r'<link (?=[^>]*rel="next")[^>]*href="([^"]+)"', data
+        ).group(1)
+
+        rv = self.client.get(next_url.replace("&amp;", "&"))
+        data = rv.get_data(as_text=True)
+        ok_("rev 0" in data and "rev 1" not in data)
+        ok_('rel="next"' not in data)
+
     def test_delete_page(self):
         self.app.config["WIKI_LOCKED_PAGES"] = ["test"]
         self.assert_403(self.client.delete(url_for("wiki.page_write", name="test")))
@@ -1,15 +1,15 @@
-import collections
-import itertools
-import sys
 from datetime import datetime
 
-from flask import abort, g, render_template, request, redirect, Blueprint, flash, url_for, current_app, make_response
+from flask import abort, g, render_template, request, redirect, Blueprint, flash, url_for, current_app, make_response, \
+    Response, stream_with_context
 from werkzeug.contrib.atom import AtomFeed
 from flask_login import login_required, current_user
+from six import text_type
 
 from realms.version import __version__
 from realms.lib.util import to_canonical, remove_ext, gravatar_url
-from .models import PageNotFound
+from .index import paginate
+from .models import PageConflict, PageNotFound
 
 blueprint = Blueprint('wiki', __name__, template_folder='templates',
                       static_folder='static', static_url_path='/static/wiki')
@@ -22,12 +22,16 @@ def commit(name, sha):
 
     cname = to_canonical(name)
 
-    data = g.current_wiki.get_page(cname, sha=sha.decode())
+    try:
+        snapshot = g.current_wiki.snapshot(sha)
+    except KeyError:
+        abort(404)
+    data = snapshot.get_page(cname)
 
     if not data:
         abort(404)
 
-    partials = _partials(data.imports, sha=sha.decode())
+    partials = snapshot.partials(data.imports)
 
     return render_template('wiki/page.html', name=name, page=data, commit=sha, partials=partials)
 
@@ -61,12 +65,12 @@ def revert():
                                                     username=current_user.username,
                                                     email=current_user.email)
     except PageNotFound as e:
-        return dict(error=True, message=e.message), 404
+        return dict(error=True, message=str(e)), 404
 
     if sha:
         flash("Page reverted")
 
-    return dict(sha=sha.decode())
+    return dict(sha=_commit_sha(sha))
 
 
 @blueprint.route("/_history/<path:name>")
@@ -82,20 +86,29 @@ def feed(name):
         return current_app.login_manager.unauthorized()
     cname = to_canonical(name)
     wiki_name = current_app.config['SITE_TITLE']
-    start = 0
     length = int(request.args.get('length', 20))
 
+    page = g.current_wiki.get_page(cname)
+    try:
+        items, cursor = page.history_page(0, length, cursor=request.args.get('cursor'))  # type: list[dict]
+    except (ValueError, KeyError):
+        abort(400)
+
+    links = []
+    if cursor:
+        # Older changes
+        links.append(dict(rel='next', href=url_for('wiki.feed', name=cname, length=length, cursor=cursor,
+                                                   _external=True)))
+
     the_feed = AtomFeed(
         title="{} - Recent changes for page '{}'".format(wiki_name, cname),
         url=url_for('wiki.page', name=cname, _external=True),
         id="{}_pagefeed_{}".format(to_canonical(wiki_name), cname),
         feed_url=url_for('wiki.feed', name=cname, _external=True),
-        generator=("Realms wiki", 'https://github.com/scragg0x/realms-wiki', __version__)
+        generator=("Realms wiki", 'https://github.com/scragg0x/realms-wiki', __version__),
+        links=links
     )
 
-    page = g.current_wiki.get_page(cname)
-    items = list(itertools.islice(page.history, start, start + length))  # type: list[dict]
-
     for item in items:
         the_feed.add(
             title="Commit '{}'".format(item['sha']),
@@ -120,14 +133,19 @@ def history_data(name):
     start = int(request.args.get('start', 0))
     length = int(request.args.get('length', 10))
     page = g.current_wiki.get_page(name)
-    items = list(itertools.islice(page.history, start, start + length))     # type: list[dict]
+    try:
+        items, cursor = page.history_page(start, length, cursor=request.args.get('cursor'))  # type: list[dict]
+    except (ValueError, KeyError):
+        abort(400)
     for item in items:
         item['gravatar'] = gravatar_url(item['author_email'])
         item['DT_RowId'] = item['sha']
         date = datetime.fromtimestamp(item['time'])
         item['date'] = date.strftime(current_app.config.get('DATETIME_FORMAT', '%b %d, %Y %I:%M %p'))
         item['link'] = url_for('.commit', name=name, sha=item['sha'])
-    total_records, hist_complete = page.history_cache
+    total_records, hist_complete = page.history_count, True
+    if total_records is None:
+        total_records, hist_complete = page.history_cache
     if not hist_complete:
         # Force datatables to fetch more data when it gets to the end
         total_records += 1
@@ -136,7 +154,8 @@ def history_data(name):
         'recordsTotal': total_records,
         'recordsFiltered': total_records,
         'data': items,
-        'fully_loaded': hist_complete
+        'fully_loaded': hist_complete,
+        'cursor': cursor
     }
 
 
@@ -144,7 +163,7 @@ def history_data(name):
 @login_required
 def edit(name):
     cname = to_canonical(name)
-    page = g.current_wiki.get_page(cname)
+    page = g.current_wiki.snapshot().get_page(cname)
 
     if not page:
         # Page doesn't exist
@@ -155,34 +174,25 @@ def edit(name):
                            name=cname,
                            content=page.data.decode(),
                            # TODO: Remove this? See #148
-                           info=next(page.history),
-                           sha=page.sha)
-
-
-def _partials(imports, sha='HEAD'):
-    page_queue = collections.deque(imports)
-    partials = collections.OrderedDict()
-    while page_queue:
-        page_name = page_queue.popleft()
-        if page_name in partials:
-            continue
-        page = g.current_wiki.get_page(page_name, sha=sha.decode())
-        try:
-            partials[page_name] = page.data
-        except KeyError:
-            partials[page_name] = "`Error importing wiki page '{0}'`".format(page_name)
-            continue
-        page_queue.extend(page.imports)
-    # We want to retain the order (and reverse it) so that combining metadata from the imports works
-    # nested list for python >3.5 compatibility
-    return list(reversed(list(partials.items())))
+                           info=page.last_rev,
+                           sha=page.commit_id.decode())
 
 
 @blueprint.route("/_partials")
 def partials():
     if current_app.config.get('PRIVATE_WIKI') and current_user.is_anonymous:
         return current_app.login_manager.unauthorized()
-    return {'partials': _partials(request.args.getlist('imports[]'))}
+    return {'partials': g.current_wiki.snapshot().partials(request.args.getlist('imports[]'))}
+
+
+@blueprint.route("/_pages")
+def find_pages():
+    if current_app.config.get('PRIVATE_WIKI') and current_user.is_anonymous:
+        return current_app.login_manager.unauthorized()
+    key = request.args.get('key')
+    if not key:
+        abort(400)
+    return {'pages': g.current_wiki.find_pages(key, request.args.get('value'))}
 
 
 @blueprint.route("/_create/", defaults={'name': None})
@@ -201,32 +211,20 @@ def create(name):
                            info={})
 
 
-def _get_subdir(path, depth):
-    parts = path.split('/', depth)
-    if len(parts) > depth:
-        return parts[-2]
-
-
-def _tree_index(items, path=""):
-    depth = len(path.split("/"))
-    items = sorted(items, key=lambda x: x['name'])
-    for subdir, items in itertools.groupby(items, key=lambda x: _get_subdir(x['name'], depth)):
-        if not subdir:
-            for item in items:
-                yield dict(item, dir=False)
-        else:
-            size = 0
-            ctime = sys.maxint
-            mtime = 0
-            for item in items:
-                size += item['size']
-                ctime = min(item['ctime'], ctime)
-                mtime = max(item['mtime'], mtime)
-            yield dict(name=path + subdir + "/",
-                       mtime=mtime,
-                       ctime=ctime,
-                       size=size,
-                       dir=True)
+def _stream_template(template_name, **context):
+    """Render a template in chunks, so the response starts before rendering ends."""
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(100)
+    return Response(stream_with_context(stream))
+
+
+def _index_items(path):
+    snapshot = g.current_wiki.index
+    if request.args.get('flat', '').lower() in ['yes', '1', 'true']:
+        return snapshot.prefixed(path)
+    node = snapshot.tree.lookup(path)
+    return node.listing() if node else []
 
 
 @blueprint.route("/_index", defaults={"path": ""})
@@ -235,14 +233,39 @@ def index(path):
     if current_app.config.get('PRIVATE_WIKI') and current_user.is_anonymous:
         return current_app.login_manager.unauthorized()
 
-    items = g.current_wiki.get_index()
     if path:
         path = to_canonical(path) + "/"
-        items = filter(lambda x: x['name'].startswith(path), items)
-    if not request.args.get('flat', '').lower() in ['yes', '1', 'true']:
-        items = _tree_index(items, path=path)
 
-    return render_template('wiki/index.html', index=items, path=path)
+    return _stream_template('wiki/index.html', index=_index_items(path), path=path)
+
+
+@blueprint.route("/_index_data", defaults={"path": ""})
+@blueprint.route("/_index_data/<path:path>")
+def index_data(path):
+    """Ajax provider for paginated index data."""
+    if current_app.config.get('PRIVATE_WIKI') and current_user.is_anonymous:
+        return current_app.login_manager.unauthorized()
+
+    if path:
+        path = to_canonical(path) + "/"
+    start = int(request.args.get('start', 0))
+    length = min(int(request.args.get('length', 100)), 1000)
+    try:
+        items, total, cursor = paginate(_index_items(path),
+                                        sort=request.args.get('sort', 'name'),
+                                        reverse=request.args.get('order') == 'desc',
+                                        start=start,
+                                        length=length,
+                                        cursor=request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+
+    return {
+        'path': path,
+        'recordsTotal': total,
+        'data': [dict(item, sha=item['sha'].decode()) if 'sha' in item else item for item in items],
+        'cursor': cursor
+    }
 
 
 @blueprint.route("/<path:name>", methods=['POST', 'PUT', 'DELETE'])
@@ -261,10 +284,14 @@ def page_write(name):
         if cname in current_app.config.get('WIKI_LOCKED_PAGES'):
             return dict(error=True, message="Page is locked"), 403
 
-        sha = g.current_wiki.get_page(cname).write(request.form['content'],
-                                                   message=request.form['message'],
-                                                   username=current_user.username,
-                                                   email=current_user.email)
+        try:
+            sha = g.current_wiki.get_page(cname).write(request.form['content'],
+                                                       message=request.form['message'],
+                                                       username=current_user.username,
+                                                       email=current_user.email,
+                                                       base_sha=_base_sha())
+        except PageConflict as e:
+            return dict(error=True, message=str(e)), 409
 
     elif request.method == 'PUT':
         edit_cname = to_canonical(request.form['name'])
@@ -272,15 +299,21 @@ def page_write(name):
         if edit_cname in current_app.config.get('WIKI_LOCKED_PAGES'):
             return dict(error=True, message="Page is locked"), 403
 
-        if edit_cname != cname:
-            g.current_wiki.get_page(cname).rename(edit_cname)
+        try:
+            if edit_cname != cname:
+                g.current_wiki.get_page(cname).rename(edit_cname)
 
-        sha = g.current_wiki.get_page(edit_cname).write(request.form['content'],
-                                                        message=request.form['message'],
-                                                        username=current_user.username,
-                                                        email=current_user.email)
+            # The base commit has the page under its old name
+            sha = g.current_wiki.get_page(edit_cname).write(request.form['content'],
+                                                            message=request.form['message'],
+                                                            username=current_user.username,
+                                                            email=current_user.email,
+                                                            base_sha=_base_sha(),
+                                                            base_name=cname)
+        except PageConflict as e:
+            return dict(error=True, message=str(e)), 409
 
-        return dict(sha=sha.decode())
+        return dict(sha=_commit_sha(sha))
 
     elif request.method == 'DELETE':
         # DELETE
@@ -290,7 +323,77 @@ def page_write(name):
         sha = g.current_wiki.get_page(cname).delete(username=current_user.username,
                                                     email=current_user.email)
 
-    return dict(sha=sha.decode())
+    return dict(sha=_commit_sha(sha))
+
+
+def _base_sha():
+    # Commit the editor loaded the page from, changes since then get merged
+    sha = request.form.get('sha')
+    if sha and sha != 'HEAD':
+        return sha
+    return None
+
+
+def _commit_sha(sha):
+    # Writes that changed nothing don't commit, the page is as of HEAD
+    return (sha or g.current_wiki.resolve()).decode()
+
+
+@blueprint.route("/_transaction", methods=['POST'])
+@login_required
+def transaction():
+    """Change several pages in one commit.
+
+    Takes a JSON body with an optional ``message`` and a list of ``changes``, each
+    one of ``{"action": "write", "name": ..., "content": ...}``,
+    ``{"action": "rename", "name": ..., "new_name": ...}`` or
+    ``{"action": "delete", "name": ...}``, applied in order.
+    """
+    if not current_app.config.get('ALLOW_ANON') and current_user.is_anonymous:
+        return dict(error=True, message="Anonymous posting not allowed"), 403
+
+    data = request.get_json(silent=True) or {}
+    changes = data.get('changes')
+    if not isinstance(changes, list):
+        return dict(error=True, message="Missing changes"), 400
+
+    txn = g.current_wiki.transaction()
+    locked = current_app.config.get('WIKI_LOCKED_PAGES')
+    for change in changes:
+        if not isinstance(change, dict):
+            return dict(error=True, message="Invalid change"), 400
+        action = change.get('action')
+        cname = to_canonical(change.get('name') or '')
+        new_cname = to_canonical(change.get('new_name') or '')
+        if not cname or (action == 'rename' and not new_cname):
+            return dict(error=True, message="Invalid name"), 400
+        if cname in locked or new_cname in locked:
+            return dict(error=True, message="Page is locked"), 403
+
+        content = change.get('content', '')
+        if action == 'write' and not isinstance(content, text_type):
+            return dict(error=True, message="Invalid content"), 400
+
+        try:
+            if action == 'write':
+                txn.write_page(cname, content)
+            elif action == 'rename':
+                txn.rename_page(cname, new_cname)
+            elif action == 'delete':
+                txn.delete_page(cname)
+            else:
+                return dict(error=True, message="Invalid action"), 400
+        except PageNotFound:
+            return dict(error=True, message="Page not found: %s" % cname), 404
+
+    try:
+        sha = txn.save_transaction(message=data.get('message'),
+                                   username=current_user.username,
+                                   email=current_user.email)
+    except PageConflict as e:
+        return dict(error=True, message="Changed since it was read: %s" % e), 409
+
+    return dict(sha=_commit_sha(sha))
 
 
 @blueprint.route("/", defaults={'name': 'home'})
@@ -303,9 +406,10 @@ def page(name):
     if cname != name:
         return redirect(url_for('wiki.page', name=cname))
 
-    data = g.current_wiki.get_page(cname)
+    snapshot = g.current_wiki.snapshot()
+    data = snapshot.get_page(cname)
 
     if data:
-        return render_template('wiki/page.html', name=cname, page=data, partials=_partials(data.imports))
+        return render_template('wiki/page.html', name=cname, page=data, partials=snapshot.partials(data.imports))
     else:
         return redirect(url_for('wiki.create', name=cname))
@@ -0,0 +1,138 @@
+import stat
+import threading
+import time
+from contextlib import contextmanager
+
+from dulwich.objects import Tree
+
+from realms3.concurrency import file_lock
+
+
+def update_tree(object_store, tree_id, changes):
+    """Apply changes to a tree, writing only the subtrees they touch.
+
+    :param object_store: Object store to read and write trees in.
+    :param tree_id: Tree sha, None to start from an empty tree.
+    :param changes: dict -- path (bytes) -> (mode, sha), or None to delete it
+    :return: bytes -- New tree sha, None if it ends up empty
+
+    """
+    tree = Tree()
+    if tree_id is not None:
+        for name, mode, sha in object_store[tree_id].iteritems():
+            tree.add(name, mode, sha)
+
+    subtrees = {}
+    for path, entry in changes.items():
+        name, _, rest = path.partition(b"/")
+        if rest:
+            subtrees.setdefault(name, {})[rest] = entry
+        elif entry is None:
+            if name in tree:
+                del tree[name]
+        else:
+            tree.add(name, entry[0], entry[1])
+
+    for name, sub_changes in subtrees.items():
+        sub_id = None
+        if name in tree:
+            mode, sha = tree[name]
+            if stat.S_ISDIR(mode):
+                sub_id = sha
+        sub_id = update_tree(object_store, sub_id, sub_changes)
+        if sub_id is None:
+            if name in tree:
+                del tree[name]
+        else:
+            tree.add(name, stat.S_IFDIR, sub_id)
+
+    if not len(tree):
+        return None
+    object_store.add_object(tree)
+    return tree.id
+
+
+class _Write(object):
+    def __init__(self, apply):
+        self.apply = apply
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class WriteCoordinator(object):
+    """Serialises writes to a repository and runs them in batches.
+
+    Writers queue up and whichever thread gets the lock first commits everything
+    queued so far, in order, under a lock file shared with other processes. Each
+    write still gets its own commit and caller, but a batch takes the locks once
+    and ``before_batch``/``after_batch`` run once for all of it. If ``after_batch``
+    fails, so do all the writes of the batch, so it should only raise when they
+    didn't take effect.
+
+    :param lock_path: Lock file guarding the repository across processes.
+    :param window: Seconds a batch waits for more writes before it runs.
+    :param before_batch: Called under the lock before every batch.
+    :param after_batch: Called under the lock after every batch.
+
+    """
+
+    def __init__(self, lock_path, window=0, before_batch=None, after_batch=None):
+        self.lock_path = lock_path
+        self.window = window
+        self.before_batch = before_batch
+        self.after_batch = after_batch
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+
+    def submit(self, apply):
+        """Run a write, batched with concurrent ones.
+
+        :param apply: Callable doing the write, run by the thread committing the
+            batch.
+        :return: What ``apply`` returned, exceptions are raised in the caller
+
+        """
+        write = _Write(apply)
+        with self._pending_lock:
+            self._pending.append(write)
+
+        with self._lock:
+            if not write.done:
+                if self.window:
+                    time.sleep(self.window)
+                with self._pending_lock:
+                    batch, self._pending = self._pending, []
+                self._run(batch)
+
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    @contextmanager
+    def locked(self):
+        """Hold off writes from this and other processes, e.g. for maintenance."""
+        with self._lock:
+            with file_lock(self.lock_path):
+                yield
+
+    def _run(self, batch):
+        with file_lock(self.lock_path):
+            try:
+                if self.before_batch is not None:
+                    self.before_batch()
+                for write in batch:
+                    try:
+                        write.result = write.apply()
+                    except Exception as e:
+                        write.error = e
+                if self.after_batch is not None:
+                    self.after_batch()
+            except Exception as e:
+                for write in batch:
+                    if write.error is None:
+                        write.error = e
+            finally:
+                for write in batch:
+                    write.done = True